@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+
+#
+# File: benchmark.py
+#
+# mt2mw -- package for migrating a Mindtouch wiki to MediaWiki
+# Copyright (C) 2010 Catalyst IT Ltd
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+end to end benchmark of a migration against local stand-ins for the
+MindTouch and MediaWiki servers
+
+    python benchmark.py --depth 3 --fanout 5 --attachments 2
+    python benchmark.py --set pipeline=true --json run.json
+    python benchmark.py --baseline run.json
+
+The fake servers run in their own process so they do not compete with
+the migration for the interpreter. The synthetic tree is the same for
+the same arguments, so runs can be compared with each other.
+"""
+
+# system library
+import sys
+import os
+import json
+import time
+import email.parser
+import argparse
+import hashlib
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import configparser as cp
+import multiprocessing as mp
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape, quoteattr
+
+WORDS = ('migration wiki page content history table list link section '
+         'attachment revision server archive review draft index').split()
+
+
+class SyntheticTree:
+    """
+    a page tree of the given depth and fan-out, generated from a seed
+
+    Page 1 is the homepage, each page has page_size bytes of html and
+    attachments files of attachment_size bytes.
+    """
+
+    def __init__(self, depth=3, fanout=5, page_size=4096, attachments=1,
+                 attachment_size=65536, seed=1):
+        self.depth = depth
+        self.fanout = fanout
+        self.page_size = page_size
+        self.attachments = attachments
+        self.attachment_size = attachment_size
+        self.seed = seed
+        # id -> (title, path, [subpage ids])
+        self.pages = dict()
+        self.add_page(None, 0)
+
+    def add_page(self, parent, level):
+        id = len(self.pages) + 1
+        if parent is None:
+            title = 'Bench Home'
+            path = ''
+        else:
+            ptitle, ppath, siblings = self.pages[parent]
+            title = 'Page {0}'.format(id)
+            path = '{0}/{1}'.format(ppath, title) if ppath else title
+            siblings.append(id)
+        self.pages[id] = (title, path, list())
+        if level < self.depth:
+            for i in range(self.fanout):
+                self.add_page(id, level + 1)
+        return id
+
+    def sitemap(self):
+        out = ['<pages>']
+        self.page_xml(1, out)
+        out.append('</pages>')
+        return ''.join(out).encode('utf-8')
+
+    def page_xml(self, id, out):
+        title, path, subpages = self.pages[id]
+        out.append('<page id="{0}"><title>{1}</title><path>{2}</path>'
+                   '<date.modified>2010-01-01T00:00:00Z</date.modified><subpages>'
+                   .format(id, escape(title), escape(path)))
+        for subpage in subpages:
+            self.page_xml(subpage, out)
+        out.append('</subpages></page>')
+
+    def html(self, id):
+        rnd = random.Random(self.seed * 1000003 + id)
+        parts = ['<h2>{0}</h2>'.format(self.pages[id][0])]
+        size = 0
+        while size < self.page_size:
+            kind = rnd.randrange(4)
+            words = ' '.join(rnd.choice(WORDS) for i in range(rnd.randrange(20, 60)))
+            if kind == 0:
+                part = '<h3>{0}</h3><p>{1}</p>'.format(words[:30], words)
+            elif kind == 1:
+                part = '<ul>{0}</ul>'.format(''.join(
+                    '<li>{0}</li>'.format(w) for w in words.split()[:8]))
+            elif kind == 2:
+                part = '<p><a href="/Page_{0}">{1}</a> <b>{1}</b> {2}</p>'.format(
+                    rnd.randrange(1, len(self.pages) + 1), words[:20], words)
+            else:
+                part = '<table><tr><td>{0}</td><td>{1}</td></tr></table>'.format(
+                    words[:40], words[40:])
+            parts.append(part)
+            size += len(part)
+        return ''.join(parts)
+
+    def contents(self, id):
+        return '<content type="text/html"><body>{0}</body></content>'.format(
+            escape(self.html(id))).encode('utf-8')
+
+    def files(self, id, baseurl):
+        out = ['<files count="{0}">'.format(self.attachments)]
+        for n in range(self.attachments):
+            name = 'file-{0}-{1}.bin'.format(id, n)
+            href = '{0}/@api/deki/files/{1}/={2}'.format(baseurl, id * 1000 + n, name)
+            out.append('<file id="{0}" revision="1"><filename>{1}</filename>'
+                       '<contents type="application/octet-stream" size="{2}" href={3}/>'
+                       '</file>'.format(id * 1000 + n, name, self.attachment_size,
+                                        quoteattr(href)))
+        out.append('</files>')
+        return ''.join(out).encode('utf-8')
+
+    def attachment(self, fileid):
+        block = hashlib.sha256('{0}:{1}'.format(self.seed, fileid).encode()).digest()
+        return (block * (self.attachment_size // len(block) + 1))[:self.attachment_size]
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    """
+    keep-alive request handler counting the bytes it moves
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes, without this Nagle and
+    # delayed acks hold every reply back by about 40ms
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, body, status=200, ctype='text/xml; charset=utf-8'):
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count('sent', len(body))
+
+    def read_body(self):
+        size = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(size) if size else b''
+        self.server.count('received', len(body))
+        return body
+
+    def do_stats(self):
+        self.reply(json.dumps(self.server.counters).encode(), ctype='application/json')
+
+
+class FakeMindTouch(FakeHandler):
+    """
+    the deki api calls made by MTWiki
+    """
+
+    def do_GET(self):
+        tree = self.server.tree
+        path = urllib.parse.urlsplit(self.path).path
+        parts = path.strip('/').split('/')
+        if path == '/__stats':
+            return self.do_stats()
+        if parts[:2] != ['@api', 'deki']:
+            return self.reply(b'<html><body>MindTouch</body></html>', ctype='text/html')
+        parts = parts[2:]
+        try:
+            if parts == ['pages']:
+                return self.reply(tree.sitemap())
+            if parts[0] == 'pages' and int(parts[1]) in tree.pages:
+                if parts[2] == 'contents':
+                    return self.reply(tree.contents(int(parts[1])))
+                if parts[2] == 'files':
+                    return self.reply(tree.files(int(parts[1]), self.server.baseurl))
+            if parts[0] == 'files':
+                if int(parts[1]) in self.server.fail_files:
+                    return self.reply(b'<error>failed</error>', status=500)
+                self.server.count('downloads')
+                return self.reply(tree.attachment(int(parts[1])),
+                                  ctype='application/octet-stream')
+        except (IndexError, ValueError):
+            pass
+        self.reply(b'<error>not found</error>', status=404)
+
+
+class FakeMediaWiki(FakeHandler):
+    """
+    an api.php that accepts every login, edit and upload
+
+    The answers carry the fields the wikitools client looks for in
+    siteinfo, token, login, page info, edit and upload replies.
+    """
+
+    def params(self):
+        query = urllib.parse.urlsplit(self.path).query
+        params = dict(urllib.parse.parse_qsl(query))
+        if self.command != 'POST':
+            return params
+        body = self.read_body()
+        ctype = self.headers.get('Content-Type', '')
+        if ctype.startswith('multipart/'):
+            msg = email.parser.BytesParser().parsebytes(
+                b'Content-Type: ' + ctype.encode() + b'\r\n\r\n' + body)
+            for part in msg.get_payload():
+                name = part.get_param('name', header='content-disposition')
+                if name and part.get_filename() is None:
+                    params[name] = part.get_payload(decode=True).decode('utf-8', 'replace')
+        else:
+            params.update(urllib.parse.parse_qsl(body.decode('utf-8', 'replace')))
+        return params
+
+    def do_GET(self):
+        if urllib.parse.urlsplit(self.path).path == '/__stats':
+            return self.do_stats()
+        self.answer(self.params())
+
+    def do_POST(self):
+        self.answer(self.params())
+
+    def answer(self, params):
+        action = params.get('action', 'query')
+        token = '0123456789abcdef+\\'
+        if action == 'login':
+            result = {'login': {'result': 'Success', 'lguserid': 1,
+                                'lgusername': params.get('lgname', 'bench'),
+                                'token': token, 'lgtoken': token}}
+        elif action == 'edit':
+            # MediaWiki:Mainpage is not a page of the tree
+            if params.get('title', '').startswith('MediaWiki:'):
+                self.server.count('meta_edits')
+            else:
+                self.server.count('edits')
+            result = {'edit': {'result': 'Success', 'title': params.get('title'),
+                               'newrevid': self.server.counters['edits']}}
+        elif action == 'upload':
+            self.server.count('uploads')
+            result = {'upload': {'result': 'Success', 'filename': params.get('filename')}}
+        elif action == 'logout':
+            result = {}
+        else:
+            result = {'query': self.query(params, token)}
+        self.reply(json.dumps(result).encode(), ctype='application/json')
+
+    @staticmethod
+    def query(params, token):
+        result = {
+            'general': {
+                'mainpage': 'Main Page', 'sitename': 'Bench',
+                'generator': 'MediaWiki 1.35.0', 'case': 'first-letter',
+                'server': '', 'articlepath': '/index.php/$1', 'base': '',
+            },
+            'namespaces': dict((str(id), {'id': id, '*': name, 'canonical': name,
+                                          'case': 'first-letter'})
+                               for id, name in ((-1, 'Special'), (0, ''), (2, 'User'),
+                                                (6, 'File'), (8, 'MediaWiki'))),
+            'namespacealiases': [],
+            'userinfo': {'id': 1, 'name': 'bench'},
+            'tokens': {'csrftoken': token, 'edittoken': token, 'logintoken': token},
+        }
+        titles = params.get('titles')
+        if titles:
+            result['pages'] = dict(
+                (str(-1 - i), {'ns': 0, 'title': title, 'missing': '',
+                               'edittoken': token, 'csrftoken': token})
+                for i, title in enumerate(titles.split('|')))
+        return result
+
+
+class FakeServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, handler, tree, fail_files=()):
+        super(FakeServer, self).__init__(('127.0.0.1', 0), handler)
+        self.tree = tree
+        # attachment ids whose download answers 500
+        self.fail_files = set(fail_files)
+        self.baseurl = 'http://127.0.0.1:{0}'.format(self.server_address[1])
+        self.lock = threading.Lock()
+        self.counters = {'sent': 0, 'received': 0, 'edits': 0, 'meta_edits': 0,
+                         'uploads': 0, 'downloads': 0}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+
+def serve(treeargs, conn, fail_files=()):
+    """
+    run both fake servers until the parent closes conn
+    """
+    tree = SyntheticTree(**treeargs)
+    servers = [FakeServer(FakeMindTouch, tree, fail_files), FakeServer(FakeMediaWiki, tree)]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    conn.send([server.baseurl for server in servers])
+    try:
+        conn.recv()
+    except EOFError:
+        pass
+    for server in servers:
+        server.shutdown()
+
+
+def server_stats(baseurl):
+    with urllib.request.urlopen(baseurl + '/__stats') as response:
+        return json.loads(response.read().decode())
+
+
+def peak_rss():
+    """
+    peak resident set size in MiB of this process and of its children
+    (convert.pl workers and converter processes)
+    """
+    scale = 1.0 / 1024 if sys.platform != 'darwin' else 1.0 / 1024 / 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return round(own, 1), round(children, 1)
+
+
+def run_benchmark(treeargs, options=None, verbose=False):
+    """
+    migrate a synthetic tree and return the measurements
+    """
+    # imported here so the server process does not load the converter
+    from mt2mw import mt2mwapp
+
+    options = options or dict()
+    workdir = tempfile.mkdtemp(prefix='mt2mw-bench-')
+    ctx = mp.get_context('spawn')
+    conn, child = ctx.Pipe()
+    proc = ctx.Process(target=serve, args=(treeargs, child), daemon=True)
+    proc.start()
+    try:
+        mturl, mwurl = conn.recv()
+
+        cfg = cp.ConfigParser(interpolation=None)
+        cfg['config'] = {
+            'mindtouch_url': mturl,
+            'mindtouch_user': '',
+            'mindtouch_password': '',
+            'mediawiki_url': mwurl,
+            'mediawiki_user': 'bench',
+            'mediawiki_password': 'bench',
+            'direct_db': '',
+            'dataroot': os.path.join(workdir, 'images'),
+            'staging_dir': os.path.join(workdir, 'staging'),
+            'journal_file': os.path.join(workdir, 'journal.sqlite'),
+            'report_file': os.path.join(workdir, 'report.json'),
+            'api_rate': '1000',
+            'api_burst': '1000',
+            'progress_interval': '0',
+            'log_level': 'info' if verbose else 'warning',
+        }
+        cfg['config'].update(options)
+        configfile = os.path.join(workdir, 'config.ini')
+        with open(configfile, 'w') as f:
+            cfg.write(f)
+
+        app = mt2mwapp()
+        app.configfile = configfile
+        app.configure()
+        start = time.perf_counter()
+        app.migratewiki()
+        elapsed = time.perf_counter() - start
+
+        mt = server_stats(mturl)
+        mw = server_stats(mwurl)
+        with open(cfg['config']['report_file']) as f:
+            report = json.load(f)
+    finally:
+        conn.close()
+        proc.join(10)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    tree = SyntheticTree(**treeargs)
+    transferred = mt['sent'] + mw['received']
+    rss, children_rss = peak_rss()
+    return {
+        'tree': dict(treeargs, pages=len(tree.pages),
+                     files=len(tree.pages) * tree.attachments),
+        'options': options,
+        'elapsed': round(elapsed, 3),
+        'pages': mw['edits'],
+        'uploads': mw['uploads'],
+        'pages_per_sec': round(mw['edits'] / elapsed, 2),
+        'bytes': transferred,
+        'bytes_per_sec': round(transferred / elapsed, 1),
+        'peak_rss_mb': rss,
+        'peak_children_rss_mb': children_rss,
+        'timers': dict((name, dict((k, t[k]) for k in ('count', 'mean', 'p95')))
+                       for name, t in report['timers'].items()),
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark mt2mw against local fake wikis')
+    parser.add_argument('--depth', type=int, default=3, help='levels below the homepage')
+    parser.add_argument('--fanout', type=int, default=5, help='subpages per page')
+    parser.add_argument('--page-size', type=int, default=4096, help='html bytes per page')
+    parser.add_argument('--attachments', type=int, default=1, help='files per page')
+    parser.add_argument('--attachment-size', type=int, default=65536, help='bytes per file')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+        help='config.ini option for the run, for example pipeline=true')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help='allowed pages/sec drop against the baseline (default 0.2)')
+    parser.add_argument('--verbose', action='store_true', help='show the migration output')
+    args = parser.parse_args(argv[1:])
+
+    treeargs = {
+        'depth': args.depth,
+        'fanout': args.fanout,
+        'page_size': args.page_size,
+        'attachments': args.attachments,
+        'attachment_size': args.attachment_size,
+        'seed': args.seed,
+    }
+    options = dict(option.split('=', 1) for option in args.set)
+    result = run_benchmark(treeargs, options, args.verbose)
+
+    print("Pages: {0} ({1} files) in {2:.2f}s".format(
+        result['pages'], result['uploads'], result['elapsed']))
+    print("Throughput: {0:.2f} pages/sec, {1:.0f} KiB/sec".format(
+        result['pages_per_sec'], result['bytes_per_sec'] / 1024))
+    print("Peak RSS: {0} MiB, children {1} MiB".format(
+        result['peak_rss_mb'], result['peak_children_rss_mb']))
+    for name, t in sorted(result['timers'].items()):
+        print("  {0:<24} {1:>7} calls  mean {2:.4f}s  p95 {3:.4f}s".format(
+            name, t['count'], t['mean'], t['p95']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+            f.write('\n')
+
+    if result['pages'] != result['tree']['pages']:
+        print("ERROR: {0} of {1} pages written".format(
+            result['pages'], result['tree']['pages']))
+        return 1
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        floor = baseline['pages_per_sec'] * (1 - args.tolerance)
+        if result['pages_per_sec'] < floor:
+            print("REGRESSION: {0:.2f} pages/sec, baseline {1:.2f}".format(
+                result['pages_per_sec'], baseline['pages_per_sec']))
+            return 1
+        print("Baseline: {0:.2f} pages/sec, ok".format(baseline['pages_per_sec']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
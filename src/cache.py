@@ -0,0 +1,214 @@
+#
+# File: cache.py
+#
+# mt2mw -- package for migrating a Mindtouch wiki to MediaWiki
+# Copyright (C) 2010 Catalyst IT Ltd
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# system library
+import os
+import hashlib
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+class AttachmentCache:
+    """
+    content addressed store of downloaded attachments, shared across runs
+
+    A key names a version of a source file (see File.cache_key) and maps
+    to a blob named by its sha1, so the same bytes attached to several
+    pages are stored once. When the blobs grow past max_bytes the least
+    recently used ones are removed.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if not os.path.exists(root):
+            os.makedirs(root, exist_ok=True)
+        self.db = sqlite3.connect(
+            os.path.join(root, 'index.sqlite'),
+            check_same_thread=False, isolation_level=None
+        )
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS blobs (
+                sha1 TEXT PRIMARY KEY,
+                size INTEGER,
+                used REAL
+            )''')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS keys (
+                key TEXT PRIMARY KEY,
+                sha1 TEXT,
+                width INTEGER,
+                height INTEGER,
+                bits INTEGER
+            )''')
+        self.hits = 0
+        self.misses = 0
+
+    def blob_path(self, sha1):
+        return os.path.join(self.root, sha1[:2], sha1)
+
+    @staticmethod
+    def place(src, dst):
+        """
+        make dst hold the bytes of src, hard linked when possible
+        """
+        dir = os.path.dirname(dst)
+        if not os.path.exists(dir):
+            os.makedirs(dir, exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=dir, prefix='.cache-')
+        os.close(fd)
+        os.unlink(tmppath)
+        try:
+            os.link(src, tmppath)
+        except OSError:
+            shutil.copyfile(src, tmppath)
+        os.replace(tmppath, dst)
+
+    def get(self, key, file, path):
+        """
+        copy the cached version of key to path and fill in the file's
+        sha1, size and dimensions, False if it is not cached
+        """
+        with self.lock:
+            row = self.db.execute('''
+                SELECT keys.sha1, blobs.size, width, height, bits
+                FROM keys JOIN blobs ON keys.sha1 = blobs.sha1
+                WHERE key = ?''', (key,)
+            ).fetchone()
+            if row:
+                self.db.execute('UPDATE blobs SET used = ? WHERE sha1 = ?',
+                    (time.time(), row[0]))
+        if not row or not os.path.exists(self.blob_path(row[0])):
+            self.misses += 1
+            return False
+        self.place(self.blob_path(row[0]), path)
+        file.sha1, file.filesize, file.width, file.height, file.bits = row
+        file.path = path
+        self.hits += 1
+        return True
+
+    def put(self, key, file):
+        """
+        store a freshly downloaded file under key
+        """
+        blob = self.blob_path(file.sha1)
+        if not os.path.exists(blob):
+            self.place(file.path, blob)
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO blobs (sha1, size, used) VALUES (?, ?, ?)',
+                (file.sha1, file.filesize, time.time())
+            )
+            self.db.execute(
+                'INSERT OR REPLACE INTO keys (key, sha1, width, height, bits) VALUES (?, ?, ?, ?, ?)',
+                (key, file.sha1, file.width, file.height, file.bits)
+            )
+            self.evict()
+
+    def evict(self):
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for sha1, size in self.db.execute(
+                'SELECT sha1, size FROM blobs ORDER BY used').fetchall():
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(self.blob_path(sha1))
+            except FileNotFoundError:
+                pass
+            self.db.execute('DELETE FROM keys WHERE sha1 = ?', (sha1,))
+            self.db.execute('DELETE FROM blobs WHERE sha1 = ?', (sha1,))
+            total -= size
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class ConversionCache:
+    """
+    html2wiki results stored by a hash of the input html and the
+    converter version, shared across runs
+
+    Holds at most max_entries conversions, the least recently used tenth
+    is dropped whenever the limit is passed.
+    """
+
+    def __init__(self, path, version, max_entries=100000):
+        self.path = path
+        self.version = version
+        self.max_entries = max(1, max_entries)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS conversions (
+                key TEXT PRIMARY KEY,
+                text TEXT,
+                used REAL
+            )''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS conversions_used ON conversions (used)')
+        self.count = self.db.execute('SELECT COUNT(*) FROM conversions').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, html):
+        data = '{0}\0{1}'.format(self.version, html)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def get(self, html):
+        key = self.key(html)
+        with self.lock:
+            row = self.db.execute(
+                'SELECT text FROM conversions WHERE key = ?', (key,)
+            ).fetchone()
+            if row:
+                self.hits += 1
+                self.db.execute('UPDATE conversions SET used = ? WHERE key = ?',
+                    (time.time(), key))
+                return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, html, text):
+        with self.lock:
+            cursor = self.db.execute(
+                'INSERT OR IGNORE INTO conversions (key, text, used) VALUES (?, ?, ?)',
+                (self.key(html), text, time.time())
+            )
+            self.count += cursor.rowcount
+            if self.count > self.max_entries:
+                drop = self.count - self.max_entries + self.max_entries // 10
+                self.db.execute('''
+                    DELETE FROM conversions WHERE key IN (
+                        SELECT key FROM conversions ORDER BY used LIMIT ?
+                    )''', (drop,)
+                )
+                self.count = self.db.execute('SELECT COUNT(*) FROM conversions').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -17,19 +17,51 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-@input = <STDIN>;
-
 use HTML::WikiConverter;
 use Config::Simple;
+use Encode;
 
 $cfg = new Config::Simple('config.ini');
 $url = $cfg->param('config.mindtouch_url');
 
-$html = join(' ', @input);
 $wc = new HTML::WikiConverter(
     dialect => 'MediaWiki',
     base_uri => $url, 
     wiki_uri => $url, 
 );
-print $wc->html2wiki(html => $html);
 
+if (@ARGV && $ARGV[0] eq '--server') {
+    # long running worker: read length prefixed frames from STDIN and
+    # answer each one with a length prefixed frame on STDOUT.
+    # a request is "<bytes>\n<utf-8 html>", a reply is either
+    # "<bytes>\n<utf-8 wikitext>" or "ERR <bytes>\n<message>".
+    binmode(STDIN);
+    binmode(STDOUT);
+    $| = 1;
+    while (defined($header = <STDIN>)) {
+        chomp($header);
+        $size = int($header);
+        $data = '';
+        while (length($data) < $size) {
+            $n = read(STDIN, $data, $size - length($data), length($data));
+            exit(1) unless $n;
+        }
+        @warnings = ();
+        local $SIG{__WARN__} = sub { push(@warnings, @_); };
+        $out = eval {
+            $wc->html2wiki(html => decode('UTF-8', $data));
+        };
+        if ($@ || @warnings) {
+            $err = encode('UTF-8', $@ ? $@ : join('', @warnings));
+            print 'ERR ' . length($err) . "\n" . $err;
+        } else {
+            $out = encode('UTF-8', $out);
+            print length($out) . "\n" . $out;
+        }
+    }
+    exit(0);
+}
+
+@input = <STDIN>;
+$html = join(' ', @input);
+print $wc->html2wiki(html => $html);
@@ -0,0 +1,162 @@
+#
+# File: converter.py
+#
+# mt2mw -- package for migrating a Mindtouch wiki to MediaWiki
+# Copyright (C) 2010 Catalyst IT Ltd
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# system library
+import os
+import queue
+import hashlib
+import subprocess as sp
+
+# our library
+from htmlwiki import engine_version
+
+
+def converter_version(cmd=None, engine='perl', base_uri=None):
+    """
+    changes whenever the converter engine or the base uri its links are
+    resolved against changes, conversion results cached under another
+    version are not reused
+    """
+    if engine == 'native':
+        return engine_version(base_uri)
+    if cmd is None:
+        cmd = os.path.join(os.getcwd(), 'convert.pl')
+    with open(cmd, 'rb') as f:
+        return 'convert.pl:{0}:{1}'.format(
+            hashlib.sha1(f.read()).hexdigest(), base_uri or '')
+
+
+class ConverterError(Exception):
+    """
+    the converter rejected the page (perl died or emitted warnings)
+    """
+
+
+class WorkerDied(Exception):
+    """
+    the converter process went away in the middle of a request
+    """
+
+
+class ConverterWorker:
+    """
+    one long running convert.pl process speaking the framed protocol
+    """
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.proc = None
+
+    def start(self):
+        self.proc = sp.Popen(
+            [self.cmd, '--server'], stdin=sp.PIPE, stdout=sp.PIPE
+        )
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def restart(self):
+        self.close()
+        self.start()
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout=5)
+        except sp.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc.stdout.close()
+        self.proc = None
+
+    def convert(self, data):
+        """
+        send one frame of html bytes and return the wikitext bytes
+        """
+        if not self.alive():
+            self.restart()
+        try:
+            self.proc.stdin.write(b'%d\n' % len(data))
+            self.proc.stdin.write(data)
+            self.proc.stdin.flush()
+            header = self.proc.stdout.readline()
+        except (BrokenPipeError, ValueError) as e:
+            raise WorkerDied(e)
+        if not header.endswith(b'\n'):
+            raise WorkerDied('converter exited')
+
+        header = header.strip()
+        failed = header.startswith(b'ERR ')
+        if failed:
+            header = header[4:]
+        size = int(header)
+        out = self.proc.stdout.read(size)
+        if len(out) != size:
+            raise WorkerDied('short read from converter')
+        if failed:
+            raise ConverterError(out.decode(errors='replace'))
+        return out
+
+
+class ConverterPool:
+    """
+    pool of persistent convert.pl workers shared by the threads of one process
+
+    Workers are started on first use. A worker that dies in the middle of
+    a page is restarted and the page is sent again, once.
+    """
+
+    def __init__(self, cmd=None, workers=1):
+        if cmd is None:
+            cmd = os.path.join(os.getcwd(), 'convert.pl')
+        self.cmd = cmd
+        self.size = max(1, workers)
+        self.pid = os.getpid()
+        self.workers = list()
+        self.idle = queue.Queue()
+        for i in range(self.size):
+            worker = ConverterWorker(self.cmd)
+            self.workers.append(worker)
+            self.idle.put(worker)
+
+    def convert(self, html):
+        data = html.encode()
+        worker = self.idle.get()
+        try:
+            try:
+                out = worker.convert(data)
+            except WorkerDied:
+                worker.restart()
+                out = worker.convert(data)
+        except WorkerDied:
+            worker.close()
+            raise
+        finally:
+            self.idle.put(worker)
+        return out.decode()
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
@@ -0,0 +1,70 @@
+#
+# File: download.py
+#
+# mt2mw -- package for migrating a Mindtouch wiki to MediaWiki
+# Copyright (C) 2010 Catalyst IT Ltd
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# system library
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DownloadPool:
+    """
+    threads downloading attachments ahead of the code that stores them
+
+    fetch() starts a download and returns at once, wait() blocks until
+    the file is on disk and raises whatever the download raised. A file
+    that was never fetched is downloaded by wait() itself.
+    """
+
+    def __init__(self, workers=4):
+        self.executor = ThreadPoolExecutor(max(1, workers))
+        self.lock = threading.Lock()
+        self.futures = dict()
+
+    def submit(self, file, path, cache=None):
+        """
+        (future, File object downloading path), a new download unless one
+        for path is running
+        """
+        with self.lock:
+            entry = self.futures.get(path)
+            if entry is None:
+                entry = (self.executor.submit(file.download_to, path, cache), file)
+                self.futures[path] = entry
+        return entry
+
+    def fetch(self, file, path, cache=None):
+        return self.submit(file, path, cache)[0]
+
+    def wait(self, file, path, cache=None):
+        # the entry may be gone once another waiter on path is done
+        future, source = self.submit(file, path, cache)
+        try:
+            future.result()
+            if source is not file:
+                # the same path was fetched through another File object
+                for name in ('path', 'sha1', 'filesize', 'width', 'height', 'bits'):
+                    setattr(file, name, getattr(source, name))
+        finally:
+            with self.lock:
+                if self.futures.get(path, (None,))[0] is future:
+                    del self.futures[path]
+
+    def close(self):
+        self.executor.shutdown(wait=True)
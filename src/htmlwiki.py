@@ -0,0 +1,402 @@
+#
+# File: htmlwiki.py
+#
+# mt2mw -- package for migrating a Mindtouch wiki to MediaWiki
+# Copyright (C) 2010 Catalyst IT Ltd
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# system library
+import os
+import re
+import hashlib
+import urllib.parse
+from html.parser import HTMLParser
+
+# our library
+from log import get_logger
+
+log = get_logger('htmlwiki')
+
+WHITESPACE = re.compile(r'\s+')
+SPACES = re.compile(r' {2,}')
+
+BOLD = ('b', 'strong')
+ITALIC = ('i', 'em')
+# inline tags MediaWiki accepts as they are
+PASSTHROUGH = ('code', 'tt', 'sup', 'sub', 'u', 's', 'strike', 'del', 'ins',
+               'big', 'small', 'kbd', 'var', 'samp', 'cite')
+# tags that only break the text into paragraphs
+BLOCKS = ('p', 'div', 'center', 'section', 'article', 'header', 'footer',
+          'address', 'form', 'fieldset', 'body', 'html')
+HEADINGS = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+SKIP = ('script', 'style', 'head', 'title', 'noscript', 'iframe', 'object')
+# attributes kept on tables, rows and cells
+TABLE_ATTRS = ('class', 'style', 'align', 'valign', 'border', 'width',
+               'cellpadding', 'cellspacing', 'colspan', 'rowspan', 'bgcolor')
+
+
+def escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def table_attrs(attrs):
+    return ' '.join('{0}="{1}"'.format(k, escape(v or '').replace('"', '&quot;'))
+                    for k, v in attrs if k in TABLE_ATTRS)
+
+
+class Sink:
+    """
+    something that collects blocks: the page, a list, a list item, a
+    table, a table cell or a blockquote
+    """
+
+    def __init__(self, tag, attrs=(), marker=''):
+        self.tag = tag
+        self.attrs = attrs
+        self.marker = marker
+        self.blocks = list()
+        # open inline elements, each [tag, attrs, parts]
+        self.inline = [[None, (), list()]]
+
+
+class HTMLToWiki(HTMLParser):
+    """
+    streaming html to MediaWiki markup converter
+
+    Follows the output of HTML::WikiConverter's MediaWiki dialect as
+    convert.pl uses it: links below wiki_uri become [[internal links]],
+    pre blocks become space indented lines and the text is entity
+    escaped.
+    """
+
+    def __init__(self, base_uri=None, wiki_uri=None):
+        super(HTMLToWiki, self).__init__(convert_charrefs=True)
+        self.base_uri = base_uri
+        self.wiki_uri = wiki_uri
+        self.sinks = [Sink(None)]
+        self.pre = 0
+        self.skip = 0
+
+    # input
+
+    def handle_starttag(self, tag, attrs):
+        if self.skip:
+            if tag in SKIP:
+                self.skip += 1
+            return
+        if tag in SKIP:
+            self.skip = 1
+        elif tag in BLOCKS:
+            self.flush()
+        elif tag in HEADINGS or tag in BOLD or tag in ITALIC or tag in PASSTHROUGH \
+                or tag in ('a', 'span', 'font', 'abbr', 'acronym', 'label'):
+            if tag in HEADINGS:
+                self.flush()
+            self.sink.inline.append([tag, attrs, list()])
+        elif tag == 'pre':
+            self.flush()
+            self.pre += 1
+            self.sink.inline.append([tag, attrs, list()])
+        elif tag == 'br':
+            self.add('\n' if self.pre else '<br />')
+        elif tag == 'hr':
+            self.flush()
+            self.sink.blocks.append('----')
+        elif tag == 'img':
+            self.add(self.image(dict(attrs)))
+        elif tag in ('ul', 'ol', 'dl'):
+            self.flush()
+            self.sinks.append(Sink(tag, attrs, '#' if tag == 'ol' else '*'))
+        elif tag in ('li', 'dt', 'dd'):
+            self.close_until(('ul', 'ol', 'dl'), keep=True)
+            if self.sink.tag not in ('ul', 'ol', 'dl'):
+                # a stray item, list it on its own
+                self.flush()
+                self.sinks.append(Sink('ul', (), '*'))
+            marker = {'dt': ';', 'dd': ':'}.get(tag, self.sink.marker)
+            self.sinks.append(Sink(tag, attrs, marker))
+        elif tag == 'table':
+            self.flush()
+            self.sinks.append(Sink(tag, attrs))
+            self.sink.blocks.append(('{| ' + table_attrs(attrs)).rstrip())
+        elif tag == 'caption':
+            if self.close_until(('table',), keep=True):
+                self.sinks.append(Sink(tag, attrs, '|+'))
+        elif tag == 'tr':
+            if self.close_until(('table',), keep=True):
+                self.sink.blocks.append(('|- ' + table_attrs(attrs)).rstrip())
+        elif tag in ('td', 'th'):
+            if self.close_until(('table',), keep=True):
+                self.sinks.append(Sink(tag, attrs, '!' if tag == 'th' else '|'))
+        elif tag == 'blockquote':
+            self.flush()
+            self.sinks.append(Sink(tag, attrs))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in ('br', 'hr', 'img'):
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if self.skip:
+            if tag in SKIP:
+                self.skip -= 1
+            return
+        if tag in BLOCKS:
+            self.flush()
+        elif tag in HEADINGS or tag in BOLD or tag in ITALIC or tag in PASSTHROUGH \
+                or tag in ('a', 'span', 'font', 'abbr', 'acronym', 'label', 'pre'):
+            self.close_inline(tag)
+        elif tag in ('ul', 'ol', 'dl', 'table', 'blockquote'):
+            self.close_until((tag,))
+        elif tag in ('li', 'dt', 'dd', 'td', 'th', 'caption'):
+            if any(s.tag == tag for s in self.sinks):
+                self.close_until((tag,))
+
+    def handle_data(self, data):
+        if self.skip:
+            return
+        if self.pre:
+            self.add(escape(data))
+        else:
+            self.add(escape(WHITESPACE.sub(' ', data)))
+
+    # state
+
+    @property
+    def sink(self):
+        return self.sinks[-1]
+
+    def add(self, text):
+        self.sink.inline[-1][2].append(text)
+
+    def flush(self):
+        """
+        end the running paragraph of the current sink
+        """
+        sink = self.sink
+        while len(sink.inline) > 1:
+            self.close_inline(sink.inline[-1][0])
+        parts = sink.inline[0][2]
+        text = SPACES.sub(' ', ''.join(parts)).strip()
+        del parts[:]
+        if text:
+            # a paragraph must not start with a space or it turns into pre
+            sink.blocks.append('\n'.join(line.strip() for line in text.split('\n')))
+
+    def close_inline(self, tag):
+        inline = self.sink.inline
+        if not any(frame[0] == tag for frame in inline[1:]):
+            return
+        while True:
+            name, attrs, parts = inline.pop()
+            self.render_inline(name, dict(attrs), ''.join(parts))
+            if name == tag:
+                break
+
+    def close_until(self, tags, keep=False):
+        """
+        close sinks up to the innermost one with a tag in tags, and that
+        one too unless keep, False if there is none
+        """
+        if not any(s.tag in tags for s in self.sinks[1:]):
+            return False
+        while self.sink.tag not in tags:
+            self.close_sink()
+        if not keep:
+            self.close_sink()
+        return True
+
+    def close_sink(self):
+        self.flush()
+        sink = self.sinks.pop()
+        parent = self.sink
+        if sink.tag in ('li', 'dt', 'dd'):
+            parent.blocks.extend(self.render_item(sink))
+        elif sink.tag in ('ul', 'ol', 'dl'):
+            lines = [line for block in sink.blocks for line in self.block_lines(block)]
+            if parent.tag in ('li', 'dt', 'dd'):
+                # a nested list, the item adds its own marker in front
+                parent.blocks.append(('list', lines))
+            elif lines:
+                parent.blocks.append('\n'.join(lines))
+        elif sink.tag in ('td', 'th', 'caption'):
+            parent.blocks.append(self.render_cell(sink))
+        elif sink.tag == 'table':
+            sink.blocks.append('|}')
+            parent.blocks.append('\n'.join(sink.blocks))
+        elif sink.tag == 'blockquote':
+            text = '\n\n'.join(self.block_text(b) for b in sink.blocks)
+            parent.blocks.append('<blockquote>{0}</blockquote>'.format(text))
+
+    @staticmethod
+    def block_lines(block):
+        if isinstance(block, tuple):
+            return block[1]
+        return block.split('\n')
+
+    @staticmethod
+    def block_text(block):
+        if isinstance(block, tuple):
+            return '\n'.join(block[1])
+        return block
+
+    # output
+
+    def render_item(self, sink):
+        text = list()
+        lines = list()
+        for block in sink.blocks:
+            if isinstance(block, tuple):
+                if text or not lines:
+                    lines.append('{0} {1}'.format(sink.marker, ' '.join(text)).rstrip())
+                    text = list()
+                lines.extend(sink.marker + line for line in block[1])
+            else:
+                text.append(block.replace('\n', ' '))
+        if text or not lines:
+            lines.append('{0} {1}'.format(sink.marker, ' '.join(text)).rstrip())
+        return lines
+
+    def render_cell(self, sink):
+        content = '\n\n'.join(self.block_text(b) for b in sink.blocks)
+        head = sink.marker
+        attrs = table_attrs(sink.attrs)
+        if attrs:
+            head = '{0} {1} |'.format(head, attrs)
+        if '\n' in content or content[:1] in ('*', '#', ';', ':', '{'):
+            return '{0}\n{1}'.format(head, content)
+        return '{0} {1}'.format(head, content).rstrip()
+
+    def render_inline(self, tag, attrs, text):
+        if tag in HEADINGS:
+            text = text.strip()
+            if text:
+                mark = '=' * int(tag[1])
+                self.sink.blocks.append('{0} {1} {0}'.format(mark, text))
+            return
+        if tag == 'pre':
+            self.pre -= 1
+            text = text.strip('\n')
+            if text:
+                self.sink.blocks.append('\n'.join(' ' + line for line in text.split('\n')))
+            return
+        if tag in BOLD:
+            out = "'''{0}'''".format(text) if text.strip() else text
+        elif tag in ITALIC:
+            out = "''{0}''".format(text) if text.strip() else text
+        elif tag in PASSTHROUGH:
+            out = '<{0}>{1}</{0}>'.format(tag, text) if text else ''
+        elif tag == 'a':
+            out = self.link(attrs.get('href'), text)
+        else:
+            out = text
+        self.add(out)
+
+    def wiki_title(self, url):
+        """
+        the page title of a link into the source wiki, or None
+        """
+        if not self.wiki_uri or not url.startswith(self.wiki_uri):
+            return None
+        rest = url[len(self.wiki_uri):]
+        if not rest or rest.startswith('@') or '?' in rest:
+            return None
+        rest = rest.split('#', 1)[0]
+        return urllib.parse.unquote(rest).replace('_', ' ').strip('/') or None
+
+    def link(self, href, text):
+        if not href:
+            return text
+        if href.startswith('#'):
+            return text
+        url = urllib.parse.urljoin(self.base_uri, href) if self.base_uri else href
+        title = self.wiki_title(url)
+        if title is None and not self.base_uri and not urllib.parse.urlsplit(href).scheme:
+            title = urllib.parse.unquote(href.split('#', 1)[0]).replace('_', ' ').strip('/')
+        label = text.strip()
+        if title:
+            if not label or label == title or label[:1].upper() + label[1:] == title[:1].upper() + title[1:]:
+                return '[[{0}]]'.format(label or title)
+            return '[[{0}|{1}]]'.format(title, label)
+        if not label or label == url or label == href:
+            return url
+        return '[{0} {1}]'.format(url, label)
+
+    @staticmethod
+    def image(attrs):
+        src = attrs.get('src')
+        if not src:
+            return ''
+        name = urllib.parse.unquote(urllib.parse.urlsplit(src).path.rstrip('/').split('/')[-1])
+        # mindtouch file urls end in /=name.png
+        name = name.lstrip('=')
+        parts = ['Image:' + name]
+        width = (attrs.get('width') or '').rstrip('px')
+        if width.isdigit():
+            parts.append(width + 'px')
+        if attrs.get('alt'):
+            parts.append(escape(attrs['alt']))
+        return '[[{0}]]'.format('|'.join(parts))
+
+    def result(self):
+        self.close()
+        while len(self.sinks) > 1:
+            self.close_sink()
+        self.flush()
+        return '\n\n'.join(self.block_text(b) for b in self.sink.blocks)
+
+
+def html2wiki(html, base_uri=None, wiki_uri=None):
+    parser = HTMLToWiki(base_uri, wiki_uri)
+    parser.feed(html)
+    return parser.result()
+
+
+def engine_version(base_uri=None):
+    """
+    changes whenever this converter or the base uri changes
+    """
+    with open(os.path.abspath(__file__), 'rb') as f:
+        return 'htmlwiki:{0}:{1}'.format(
+            hashlib.sha1(f.read()).hexdigest(), base_uri or '')
+
+
+class NativeConverter:
+    """
+    converts in the calling thread, same interface as ConverterPool
+
+    A page it cannot convert goes to the converter returned by fallback
+    (the convert.pl pool) when one is given.
+    """
+
+    def __init__(self, base_uri=None, wiki_uri=None, fallback=None):
+        self.base_uri = base_uri
+        self.wiki_uri = wiki_uri
+        self.fallback = fallback
+        self.pid = os.getpid()
+
+    def convert(self, html):
+        try:
+            return html2wiki(html, self.base_uri, self.wiki_uri)
+        except Exception as e:
+            if self.fallback is None:
+                raise
+            log.warning("Native conversion failed (%s), using convert.pl", e)
+            return self.fallback().convert(html)
+
+    def close(self):
+        pass
@@ -0,0 +1,156 @@
+#
+# File: journal.py
+#
+# mt2mw -- package for migrating a Mindtouch wiki to MediaWiki
+# Copyright (C) 2010 Catalyst IT Ltd
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# system library
+import os
+import sqlite3
+import threading
+import time
+
+
+class Journal:
+    """
+    on-disk record of the pages and files a migration has finished
+
+    Every entry is committed as soon as it is written, so after a crash
+    a --resume run can skip everything that made it to the target wiki.
+
+    The page_state and file_state tables describe the source as it was
+    when it was last migrated. They survive reset() and drive the
+    incremental mode.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        dir = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(dir):
+            os.makedirs(dir, exist_ok=True)
+        try:
+            self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        except sqlite3.Error as e:
+            raise sqlite3.OperationalError(
+                'cannot open the journal {0} ({1}), set journal_file in config.ini'.format(path, e))
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS pages (
+                id TEXT PRIMARY KEY,
+                title TEXT,
+                done REAL
+            )''')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS files (
+                title TEXT PRIMARY KEY,
+                page_id TEXT,
+                done REAL
+            )''')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS page_state (
+                id TEXT PRIMARY KEY,
+                modified TEXT,
+                menu TEXT,
+                digest TEXT
+            )''')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS file_state (
+                title TEXT PRIMARY KEY,
+                href TEXT,
+                revision TEXT,
+                size TEXT
+            )''')
+        self.pages = set(row[0] for row in self.db.execute('SELECT id FROM pages'))
+        self.files = set(row[0] for row in self.db.execute('SELECT title FROM files'))
+
+    @staticmethod
+    def default_path():
+        """
+        journal file in the current directory. Not next to dataroot: that
+        is inside the MediaWiki install and only a placeholder in api mode
+        """
+        return os.path.join(os.getcwd(), 'mt2mw-journal.sqlite')
+
+    def reset(self):
+        """
+        forget all finished work, used when not resuming
+        """
+        with self.lock:
+            self.db.execute('DELETE FROM pages')
+            self.db.execute('DELETE FROM files')
+            self.pages.clear()
+            self.files.clear()
+
+    def page_done(self, id):
+        return id in self.pages
+
+    def file_done(self, title):
+        return title in self.files
+
+    def mark_page(self, id, title):
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO pages (id, title, done) VALUES (?, ?, ?)',
+                (id, title, time.time())
+            )
+            self.pages.add(id)
+
+    def mark_file(self, title, page_id):
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO files (title, page_id, done) VALUES (?, ?, ?)',
+                (title, page_id, time.time())
+            )
+            self.files.add(title)
+
+    def page_state(self, id):
+        """
+        (modified, menu, digest) recorded for the page by the last run
+        """
+        with self.lock:
+            return self.db.execute(
+                'SELECT modified, menu, digest FROM page_state WHERE id = ?', (id,)
+            ).fetchone()
+
+    def set_page_state(self, id, modified, menu, digest):
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO page_state (id, modified, menu, digest) VALUES (?, ?, ?, ?)',
+                (id, modified, menu, digest)
+            )
+
+    def file_state(self, title):
+        """
+        (href, revision, size) recorded for the file by the last run
+        """
+        with self.lock:
+            return self.db.execute(
+                'SELECT href, revision, size FROM file_state WHERE title = ?', (title,)
+            ).fetchone()
+
+    def set_file_state(self, title, href, revision, size):
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO file_state (title, href, revision, size) VALUES (?, ?, ?, ?)',
+                (title, href, revision, size)
+            )
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,84 @@
+#
+# File: log.py
+#
+# mt2mw -- package for migrating a Mindtouch wiki to MediaWiki
+# Copyright (C) 2010 Catalyst IT Ltd
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# system library
+import sys
+import atexit
+import queue
+import logging
+import logging.handlers
+
+# every module logs to a child of this logger, e.g. mt2mw.mediawiki
+ROOT = 'mt2mw'
+FORMAT = '%(asctime)s %(levelname)-7s %(message)s'
+
+listener = None
+
+
+def get_logger(name):
+    return logging.getLogger('{0}.{1}'.format(ROOT, name))
+
+
+def configure_logging(level='info', logfile=None):
+    """
+    send the mt2mw loggers through a queue to stdout and, when given,
+    logfile
+
+    The callers only put records on the queue, a listener thread does
+    the formatting and the terminal and file writes. Records below level
+    are dropped before they are formatted.
+    """
+    global listener
+    stop_logging()
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+    if not isinstance(level, int):
+        raise ValueError('unknown log level: {0}'.format(level))
+
+    formatter = logging.Formatter(FORMAT)
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if logfile:
+        handlers.append(logging.FileHandler(logfile, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = queue.Queue()
+    root = logging.getLogger(ROOT)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level)
+    root.propagate = False
+    listener = logging.handlers.QueueListener(records, *handlers)
+    listener.start()
+
+
+def stop_logging():
+    """
+    write out the queued records and stop the listener thread
+    """
+    global listener
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+        listener = None
+
+atexit.register(stop_logging)
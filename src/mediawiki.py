@@ -21,16 +21,29 @@
 # system library
 import wikitools3 as wt
 import psycopg2 as pg
+from psycopg2.extras import execute_values
 import hashlib
 import os
-import traceback
-import time
-import re
+import threading
+import tempfile
+
+# our library
+from page import html2wiki, sha1_base36, walk_pages, ORDERS
+from ratelimit import RateLimiter
+from xmldump import import_local, import_api
+from stats import stats
+from log import get_logger
+from titles import TitleIndex, title_key
+
+log = get_logger('mediawiki')
+
+# passed as the text of a page whose source did not change since the
+# last run, the page is then not edited
+UNCHANGED = object()
 
 class MWWiki:
     def __init__(self, baseurl, username, password, dbconfig=None, dataroot=None):
 
-        self.debug = True
         self.dbconfig = None
         self.site = None
         apiurl = "{0}/api.php".format(baseurl)
@@ -43,24 +56,68 @@ class MWWiki:
         self.flg_showsubpages = True
         # set tp true to create pages with hierarchy, false to flatten
         self.flg_hierarchy = True
+        # page id -> MediaWiki title, see set_hierarchy
+        self.titles = TitleIndex(self.flg_hierarchy)
         
-        self.upload_delay = 1
+        # XMLDumpWriter taking the pages instead of api edits, or None
+        self.dump = None
+        # paces every api call and backs off when the server is busy
+        self.limiter = RateLimiter()
+        # stats.Progress ticked once per written page, or None
+        self.progress = None
+        # image rows are inserted and committed this many at a time
+        self.file_batch_size = 100
+        self.pending_files = list()
+        self.pending_titles = set()
+        self.pending_pages = list()
+        # api mode: titles being staged and uploaded for some page
+        self.uploading_titles = set()
+        # ids of the pages with rows in a batch that failed to insert
+        self.failed_pages = set()
+        # DownloadPool fetching attachments ahead of write_files, or None
+        self.downloads = None
+        # api uploads are staged here, unless the wiki fetches them by url
+        self.staging = os.path.join(tempfile.gettempdir(), 'mt2mw')
+        self.flg_upload_by_url = False
+        # AttachmentCache shared across runs, or None
+        self.cache = None
+        # ConversionCache used by html2wiki, only reported here
+        self.conversion_cache = None
         # MediaWiki:Mainpage holds the value of the main page in mediawiki
         # it will be updated with the name of the main page
         self.main_page = 'MediaWiki:Mainpage'
         self.pagecount = 0
         self.filecount = 0
-
-        if self.debug:
-            msg = "Opening mediawiki url: {0}, {1}".format(baseurl,username)
-            print(msg)
+        # staged concurrent pipeline, None to write one page at a time
+        self.pipeline = None
+        # record of finished work for --resume, see journal.py
+        self.journal = None
+        self.skipcount = 0
+        # only write pages and files that changed since the last run
+        self.flg_incremental = False
+        self.unchangedcount = 0
+        # title_key -> sha1 of the current text on the wiki, see load_digests
+        self.flg_skip_identical = False
+        self.digests = None
+        self.digest_batch_size = 50
+        self.identicalcount = 0
+        # title_key -> (sha1 in base 36, size) of the files on the wiki,
+        # None for missing ones, see load_file_info
+        self.remote_files = dict()
+        self.identicalfilecount = 0
+        # walk_pages order, pages are released once they are written
+        self.traversal = 'dfs'
+        # page id -> (modified, menu, digest) waiting for the page write
+        self.pending_state = dict()
+        self.lock = threading.Lock()
+        self.dblock = threading.Lock()
+
+        log.info("Opening mediawiki url: %s, %s", baseurl, username)
 
         try:
             self.site = wt.wiki.Wiki(apiurl)
         except Exception as e:
-            msg = "ERROR: mediawiki {0}".format(e)
-            print(msg)
-            print(traceback.format_exc())
+            log.exception("ERROR: mediawiki %s", e)
             
         if self.site:
             try:
@@ -68,11 +125,10 @@ class MWWiki:
                 self.dbconfig = dbconfig
                 self.dataroot = dataroot
                 if self.dbconfig:
-                    print('Database details given: files will be added directly')
+                    log.info('Database details given: files will be added directly')
                     self.connect_db()
             except Exception as e:
-                msg = "ERROR: mediawiki login {0}".format(e)
-                print(msg)
+                log.error("ERROR: mediawiki login %s", e)
 
     def set_copypages(self, v):
         self.flg_copypages = v
@@ -95,6 +151,249 @@ class MWWiki:
     def get_showsubpages(self):
         return self.flg_showsubpages
 
+    def set_journal(self, v):
+        self.journal = v
+        return self.journal
+
+    def page_done(self, page):
+        """
+        True if a previous run already wrote this page, it is then counted
+        as skipped and leaves the progress total
+        """
+        if self.journal and self.journal.page_done(page.id):
+            with self.lock:
+                self.skipcount += 1
+            if self.progress:
+                self.progress.skip()
+            return True
+        return False
+
+    def set_incremental(self, v):
+        self.flg_incremental = v
+        return self.flg_incremental
+
+    def get_incremental(self):
+        return self.flg_incremental
+
+    @staticmethod
+    def digest(text):
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def set_traversal(self, v):
+        if v not in ORDERS:
+            raise ValueError('unknown traversal order: {0}'.format(v))
+        self.traversal = v
+        return self.traversal
+
+    def set_skip_identical(self, v, batch_size=50):
+        self.flg_skip_identical = v
+        self.digest_batch_size = max(1, min(batch_size, 50))
+        return self.flg_skip_identical
+
+    def load_digests(self, pages):
+        """
+        fetch the sha1 of the current revision of every page's target
+        title, batch_size titles per request, so write_page can leave
+        out the edits that would not change anything
+        """
+        if not (self.flg_skip_identical and self.site and self.flg_copypages) or self.dump:
+            return
+        titles = list(set(self.titles.title(page) for page in pages))
+        digests = dict()
+        for i in range(0, len(titles), self.digest_batch_size):
+            batch = titles[i:i + self.digest_batch_size]
+            try:
+                result = self.api(wt.api.APIRequest(self.site, {
+                    'action': 'query',
+                    'prop': 'revisions',
+                    'rvprop': 'sha1',
+                    'titles': '|'.join(batch),
+                }).query, querycontinue=False)
+            except Exception as e:
+                log.error("Exception fetching page digests: %s", e)
+                continue
+            for info in result.get('query', {}).get('pages', {}).values():
+                revisions = info.get('revisions')
+                if revisions and 'sha1' in revisions[0]:
+                    digests[title_key(info['title'])] = revisions[0]['sha1']
+        self.digests = digests
+        log.info("Digest index: %d of %d pages already on the wiki", len(digests), len(titles))
+
+    def load_file_info(self, files):
+        """
+        look up the files the wiki already has with prop=imageinfo,
+        digest_batch_size titles per request, skipping the titles looked
+        up before
+        """
+        if not (self.flg_skip_identical and self.site) or self.dbconfig or self.dump:
+            return
+        titles = list(set(title_key(f.title) for f in files) - set(self.remote_files))
+        for i in range(0, len(titles), self.digest_batch_size):
+            batch = titles[i:i + self.digest_batch_size]
+            found = dict.fromkeys(batch)
+            try:
+                result = self.api(wt.api.APIRequest(self.site, {
+                    'action': 'query',
+                    'prop': 'imageinfo',
+                    'iiprop': 'sha1|size',
+                    'titles': '|'.join('File:' + title for title in batch),
+                }).query, querycontinue=False)
+            except Exception as e:
+                log.error("Exception fetching file info: %s", e)
+                continue
+            for info in result.get('query', {}).get('pages', {}).values():
+                imageinfo = info.get('imageinfo')
+                if imageinfo and 'sha1' in imageinfo[0]:
+                    # the api gives the sha1 in hex, File.sha1 is base 36
+                    found[title_key(info['title'].split(':', 1)[-1])] = (
+                        sha1_base36(imageinfo[0]['sha1']), str(imageinfo[0].get('size')))
+            with self.lock:
+                self.remote_files.update(found)
+        if titles:
+            log.debug("File info: %d titles looked up", len(titles))
+
+    def file_identical(self, file):
+        """
+        True when the wiki already has this file. Without a download to
+        hash (upload_by_url) a file of the same size is taken as the same
+        unless the journal recorded a different version.
+        """
+        remote = self.remote_files.get(title_key(file.title))
+        if remote is None:
+            return False
+        if file.sha1:
+            return remote[0] == file.sha1
+        return (not self.file_changed(file)
+            and (file.size is None or remote[1] == str(file.size)))
+
+    def text_identical(self, title, text):
+        """
+        True when the wiki already holds text under title. MediaWiki
+        drops trailing whitespace before it stores a revision.
+        """
+        if not self.digests:
+            return False
+        digest = self.digests.get(title_key(title))
+        return digest is not None and digest == self.digest(text.rstrip())
+
+    def page_unchanged(self, page, html=None):
+        """
+        True in incremental mode when the page is the same as in the last
+        run. Without html only the modification time can be compared.
+        """
+        if not self.journal:
+            return False
+        menu = self.digest(self.get_files_list(page) + self.get_subpage_menu(page))
+        state = self.journal.page_state(page.id)
+        if html is None:
+            unchanged = (state is not None and page.modified is not None
+                and state[0] == page.modified and state[1] == menu)
+            if unchanged:
+                # keep the recorded state, it still holds the digest
+                return self.flg_incremental
+            digest = None
+        else:
+            digest = self.digest(html)
+            unchanged = state is not None and state[1:] == (menu, digest)
+        with self.lock:
+            self.pending_state[page.id] = (page.modified, menu, digest)
+        return self.flg_incremental and unchanged
+
+    def save_page_state(self, page):
+        with self.lock:
+            state = self.pending_state.pop(page.id, None)
+        if self.journal and state:
+            self.journal.set_page_state(page.id, *state)
+
+    def page_text(self, page):
+        """
+        UNCHANGED if the page did not change since the last run, else the
+        converted text, or None to let write_page try again and report
+        """
+        if self.page_unchanged(page):
+            return UNCHANGED
+        try:
+            html = page.get_content()
+            if self.page_unchanged(page, html):
+                return UNCHANGED
+            return html2wiki(html)
+        except Exception:
+            return None
+
+    def file_changed(self, file):
+        """
+        True if the last run recorded a different version of the file
+        """
+        if not self.journal:
+            return False
+        state = self.journal.file_state(file.title)
+        return state is not None and state != (file.url, file.revision, file.size)
+
+    def file_done(self, file):
+        if self.journal is None:
+            return False
+        if self.journal.file_done(file.title):
+            return True
+        return (self.flg_incremental
+            and self.journal.file_state(file.title) == (file.url, file.revision, file.size))
+
+    def mark_file(self, file, page):
+        if self.journal:
+            self.journal.mark_file(file.title, page.id)
+            self.journal.set_file_state(file.title, file.url, file.revision, file.size)
+
+    def set_file_batch_size(self, v):
+        self.file_batch_size = max(1, v)
+        return self.file_batch_size
+
+    def set_downloads(self, v):
+        self.downloads = v
+        return self.downloads
+
+    def set_staging(self, v):
+        self.staging = v
+        return self.staging
+
+    def set_upload_by_url(self, v):
+        self.flg_upload_by_url = v
+        return self.flg_upload_by_url
+
+    def set_cache(self, v):
+        self.cache = v
+        return self.cache
+
+    def set_dump(self, v, importmode=None, importcommand=None, interwikiprefix=None):
+        """
+        write pages to an XMLDumpWriter instead of editing them, done()
+        then loads the dump with importmode 'local' or 'api'
+        """
+        self.dump = v
+        self.dump_import = importmode
+        self.dump_command = importcommand
+        self.dump_prefix = interwikiprefix
+        return self.dump
+
+    def load_dump(self):
+        files = self.dump.close()
+        msg = "Dump written: {0} pages in {1}".format(
+            self.dump.pagecount, ', '.join(files))
+        self.log_msg(msg)
+        try:
+            if self.dump_import == 'local':
+                import_local(files, self.dump_command)
+            elif self.dump_import == 'api':
+                import_api(self.site, files, self.dump_prefix, self.api)
+        except Exception as e:
+            log.exception("Exception during import: %s", e)
+
+    def set_conversion_cache(self, v):
+        self.conversion_cache = v
+        return self.conversion_cache
+
+    def set_pipeline(self, v):
+        self.pipeline = v
+        return self.pipeline
+
     def tostring(self, text):
         """
         Convert bytes to string
@@ -110,8 +409,7 @@ class MWWiki:
         log message
         """
         
-        if self.debug:
-            print(msg)
+        log.info(msg)
 
     def connect_db(self):
         try:
@@ -119,20 +417,35 @@ class MWWiki:
         except Exception as e:
             raise e
 
-    def wait_upload_delay(self):
+    def set_limiter(self, v):
+        self.limiter = v
+        return self.limiter
+
+    def set_progress(self, v):
+        self.progress = v
+        return self.progress
+
+    def api(self, func, *args, **kwargs):
         """
-        sleep for upload_delay seconds
+        make a MediaWiki api call through the shared rate limiter
         """
+        with stats.timer('mediawiki.' + getattr(func, '__name__', 'call')):
+            return self.limiter.call(func, *args, **kwargs)
 
-        if self.upload_delay > 0:
-            time.sleep(self.upload_delay)
+    def set_hierarchy(self, v):
+        self.flg_hierarchy = v
+        self.titles = TitleIndex(v)
+        return self.flg_hierarchy
+
+    def get_hierarchy(self):
+        return self.flg_hierarchy
 
     def get_subpage_menu(self, page):
         """
         """
         
         if self.flg_showsubpages:
-            return MWWiki.subpage_menu(page)
+            return MWWiki.subpage_menu(page, self.titles)
         else:
             return ''
 
@@ -142,39 +455,11 @@ class MWWiki:
         
         return MWWiki.files_list(page)
     
-    def sanitize_title(self, title):
-        """
-        Sanitize characters in page title by replacing invalid characters with "_"
-        """
-        # Define a regex pattern for invalid characters in MediaWiki page titles
-        invalid_chars = r'[#<>[\]|{}\n\r]'
-        
-        # trim leading and trailing whitespace
-        trimed_title = title.strip()
-        
-        # Replace invalid characters with "_"
-        sanitized_title = re.sub(invalid_chars, '_', title)
-        
-        if False:
-            # Replace multiple consecutive underscores with a single underscore
-            sanitized_title = re.sub(r'_+', '_', sanitized_title)
-            
-            # Trim leading and trailing underscores
-            sanitized_title = sanitized_title.strip('_')
-
-            
-        
-        if title != sanitized_title:
-            msg = "SANITIZED TITLE: {0}".format(sanitized_title)
-            print(msg)
-   
-        return sanitized_title        
-        
-
     @staticmethod
-    def subpage_menu(page):
+    def subpage_menu(page, titles=None):
         if page.subpages:
-            sublist =  '\n'.join(list('* [[%s|%s]]' % (s.path, s.title) for s in page.subpages))
+            sublist =  '\n'.join(list('* [[%s|%s]]' % (
+                titles.title(s) if titles else s.path, s.title) for s in page.subpages))
             result = "\n\n===Subpages===\n\n{0}".format(sublist)
                
 #            result = '\n\n===Subpages===\n\n%s' % '\n'.join(list('* [[%s|%s]]' % (s.path, s.title) for s in page.subpages))
@@ -191,166 +476,469 @@ class MWWiki:
         #.encode('utf-8')
         return ''
 
-    def commit_file_db(self, cursor, file):
-        filehash = hashlib.md5(file.title).hexdigest()
-        path = os.path.join(self.dataroot, filehash[:1], filehash[:2], file.title)
-        file.download_to(path)
+    def file_path(self, file):
+        """
+        where a file is stored, under dataroot for direct_db, else in the
+        staging directory it is uploaded from
+        """
+        if self.dbconfig:
+            filehash = hashlib.md5(file.title.encode('utf-8')).hexdigest()
+            return os.path.join(self.dataroot, filehash[:1], filehash[:2], file.title)
+        return os.path.join(self.staging, file.title)
+
+    def prefetch_files(self, page):
+        """
+        start downloading the page's files so they arrive while the page
+        is converted, write_files then picks them up
+        """
+        if not (self.downloads and self.flg_copyfiles):
+            return
+        if not self.dbconfig and self.flg_upload_by_url:
+            return
+        files = [f for f in page.files if not self.file_done(f)]
+        if not self.dbconfig:
+            # the page uploading it already has it staged
+            with self.lock:
+                files = [f for f in files if f.title not in self.uploading_titles]
+        if files and self.dbconfig:
+            with self.dblock, stats.timer('postgres.query'):
+                cursor = self.db.cursor()
+                cursor.execute('''
+                    SELECT img_name FROM mediawiki.image WHERE img_name = ANY(%s)''',
+                    (list(set(f.title for f in files)),)
+                )
+                existing = set(row[0] for row in cursor.fetchall())
+                cursor.close()
+            files = [f for f in files if f.title not in existing or self.file_changed(f)]
+        for file in files:
+            self.downloads.fetch(file, self.file_path(file), self.cache)
+
+    def download_file(self, file):
+        path = self.file_path(file)
+        if self.downloads:
+            self.downloads.wait(file, path, self.cache)
+        else:
+            file.download_to(path, self.cache)
+        return path
+
+    def commit_file_db(self, file, page):
+        """
+        download a file into dataroot and queue its image row, the rows
+        are inserted and committed in batches by flush_files_db. Only the
+        queueing holds dblock, False if the batch insert failed
+        """
+        self.download_file(file)
         filedata = file.get_info()
         filedata['user'] = None
         filedata['user_text'] = self.username
-        cursor.execute('''
-            INSERT INTO mediawiki.image (
-                img_name,
-                img_size,
-                img_width,
-                img_height,
-                img_metadata,
-                img_bits,
-                img_media_type,
-                img_major_mime,
-                img_minor_mime,
-                img_description,
-                img_user,
-                img_user_text,
-                img_timestamp,
-                img_sha1
-            ) VALUES (
-                %(name)s,
-                %(size)s,
-                %(width)s,
-                %(height)s,
-                %(metadata)s,
-                %(bits)s,
-                %(media_type)s,
-                %(major_mime)s,
-                %(minor_mime)s,
-                %(description)s,
-                %(user)s,
-                %(user_text)s,
-                %(timestamp)s,
-                %(sha1)s
-            );''', filedata
-        )
-        self.db.commit()
+        with self.dblock:
+            self.pending_files.append((filedata, file, page))
+            if len(self.pending_files) >= self.file_batch_size:
+                return self.flush_files_db()
+        return True
+
+    def flush_files_db(self):
+        """
+        insert the queued image rows with one statement and one commit.
+        When that fails the transaction is rolled back and neither the
+        files nor the pages waiting for them are journaled, so --resume
+        tries them again. Call with dblock held, False on failure.
+        """
+        if not self.pending_files:
+            return True
+        batch = self.pending_files
+        pages = self.pending_pages
+        self.pending_files = list()
+        self.pending_pages = list()
+        self.pending_titles.difference_update(file.title for filedata, file, page in batch)
+        cursor = None
+        try:
+            cursor = self.db.cursor()
+            with stats.timer('postgres.insert'):
+                execute_values(cursor, '''
+                    INSERT INTO mediawiki.image (
+                        img_name,
+                        img_size,
+                        img_width,
+                        img_height,
+                        img_metadata,
+                        img_bits,
+                        img_media_type,
+                        img_major_mime,
+                        img_minor_mime,
+                        img_description,
+                        img_user,
+                        img_user_text,
+                        img_timestamp,
+                        img_sha1
+                    ) VALUES %s''',
+                    [filedata for filedata, file, page in batch],
+                    template='''(
+                        %(name)s,
+                        %(size)s,
+                        %(width)s,
+                        %(height)s,
+                        %(metadata)s,
+                        %(bits)s,
+                        %(media_type)s,
+                        %(major_mime)s,
+                        %(minor_mime)s,
+                        %(description)s,
+                        %(user)s,
+                        %(user_text)s,
+                        %(timestamp)s,
+                        %(sha1)s
+                    )''',
+                    page_size=self.file_batch_size
+                )
+                self.db.commit()
+        except Exception as e:
+            log.error("Exception inserting %d files: %s", len(batch), e)
+            self.db.rollback()
+            self.failed_pages.update(page.id for filedata, file, page in batch)
+            return False
+        finally:
+            if cursor is not None:
+                cursor.close()
+        for filedata, file, page in batch:
+            log.debug("Uploaded file: %s", self.tostring(file.title))
+            self.mark_file(file, page)
+        # pages whose files were still queued when they were written
+        for page in pages:
+            self.journal_page(page)
+        return True
 
 
     def write_files_api(self, page):
+        """
+        upload the page's files through the api, False if any failed
+        """
+        flg_ok = True
         if self.site:
-            for file in page.files:
-                f = wt.wikifile.File(self.site, file.title)
-                title = self.tostring(f.title)
-                msg = "Processing file: {0}".format(title)
-                print(msg)
-                self.wait_upload_delay()
-                try:
-                    f.upload(url=file.url)
-                    msg = "Uploaded file: {0}".format(title)
-                    print(msg)
-                except Exception as e:
-                    msg = "Exception during upload: {0}".format(e)
-                    print(msg)
-                    print(traceback.format_exc())
+            files = [f for f in page.files if not self.file_done(f)]
+            self.load_file_info(files)
+            # a title shared by several pages is uploaded by the first
+            # of them, the others leave it while the upload runs
+            with self.lock:
+                files = list(dict((f.title, f) for f in files
+                    if f.title not in self.uploading_titles and not self.file_done(f)).values())
+                self.uploading_titles.update(f.title for f in files)
+            try:
+                for file in files:
+                    title = self.tostring(file.title)
+                    log.debug("Processing file: %s", title)
+                    try:
+                        # a changed file replaces the one from the last run or
+                        # the different one already on the wiki
+                        changed = (self.file_changed(file)
+                            or self.remote_files.get(title_key(file.title)) is not None)
+                        if self.flg_upload_by_url:
+                            if self.file_identical(file):
+                                self.skip_file(file, page)
+                                continue
+                            # the wiki fetches the file from the source itself
+                            f = self.api(wt.wikifile.File, self.site, file.title)
+                            self.api(f.upload, url=file.url, ignorewarnings=changed)
+                        else:
+                            path = self.download_file(file)
+                            if self.file_identical(file):
+                                os.unlink(path)
+                                self.skip_file(file, page)
+                                continue
+                            f = self.api(wt.wikifile.File, self.site, file.title)
+                            try:
+                                with open(path, 'rb') as fileobj:
+                                    def upload():
+                                        # a retry sends the file again from the start
+                                        fileobj.seek(0)
+                                        return f.upload(fileobj=fileobj, ignorewarnings=changed)
+                                    self.api(upload)
+                            finally:
+                                os.unlink(path)
+                        log.debug("Uploaded file: %s", title)
+                        self.mark_file(file, page)
+                    except Exception as e:
+                        log.exception("Exception during upload: %s", e)
+                        flg_ok = False
+            finally:
+                with self.lock:
+                    self.uploading_titles.difference_update(f.title for f in files)
         else:
-            msg = "ERROR: site is not open".format(self.site)
-            print(msg)
+            log.error("ERROR: site is not open")
+            flg_ok = False
+        return flg_ok
+
+    def skip_file(self, file, page):
+        with self.lock:
+            self.identicalfilecount += 1
+        log.debug("Already on the wiki: %s", self.tostring(file.title))
+        self.mark_file(file, page)
 
     def write_files_db(self, page):
-        cursor = self.db.cursor()
-        for file in page.files:
-            title = self.tostring(file.title)
-            cursor.execute('''
-                SELECT img_name FROM mediawiki.image WHERE img_name = %s''',
-                (file.title,)
-            )
-            if not cursor.fetchall():
-                self.commit_file_db(cursor, file)
-                msg = "Uploaded file: {0}".format(title)
-                print(msg)
-        cursor.close()
-
-
-    def write(self, page):
-        # upload the files for this page
+        """
+        store the page's files with direct_db, False if any failed. dblock
+        is only held for the queries, the downloads of several pages run
+        at the same time
+        """
+        with self.dblock:
+            files = [f for f in page.files
+                if not self.file_done(f) and f.title not in self.pending_titles]
+            if not files:
+                return True
+            cursor = self.db.cursor()
+            # one query for the whole page instead of one per file
+            with stats.timer('postgres.query'):
+                cursor.execute('''
+                    SELECT img_name FROM mediawiki.image WHERE img_name = ANY(%s)''',
+                    (list(set(f.title for f in files)),)
+                )
+                existing = set(row[0] for row in cursor.fetchall())
+            changed = [f.title for f in files if f.title in existing and self.file_changed(f)]
+            if changed:
+                # the source files changed since the last run, replace them
+                cursor.execute('''
+                    DELETE FROM mediawiki.image WHERE img_name = ANY(%s)''',
+                    (changed,)
+                )
+                existing.difference_update(changed)
+            cursor.close()
+            new = list(dict((f.title, f) for f in files if f.title not in existing).values())
+            # claimed until their rows are flushed, other pages leave them
+            self.pending_titles.update(f.title for f in new)
+        flg_ok = True
+        for file in files:
+            if file.title in existing:
+                self.mark_file(file, page)
+        for file in new:
+            try:
+                if not self.commit_file_db(file, page):
+                    flg_ok = False
+            except Exception as e:
+                log.error("Exception during download of %s: %s", file.title, e)
+                with self.dblock:
+                    self.pending_titles.discard(file.title)
+                flg_ok = False
+        return flg_ok
+
+    def write_files(self, page):
+        """
+        upload the files for this page, False if any of them failed
+        """
         if page.files and self.flg_copyfiles:
-            self.filecount += 1
+            with self.lock:
+                self.filecount += 1
             if self.dbconfig:
-                self.write_files_db(page)
-            else:
-                self.write_files_api(page)
-                
+                return self.write_files_db(page)
+            return self.write_files_api(page)
+        return True
+
+    def write_page(self, page, text=None):
+        """
+        write the page itself, text is the converted wikitext or None to
+        convert it here. Returns True when the page needs no further work.
+        """
         flg_error = False
-        self.pagecount += 1
+        flg_done = not self.flg_copypages
+        with self.lock:
+            self.pagecount += 1
         if self.flg_copypages:
             if self.site:
                     # write the page itself
                     try:
-                        title = page.title
-                        sanitized_title = self.sanitize_title(title)
-                                # check if sanitized title is the same as the original title
-                        if sanitized_title != title:
-                            print("Warning: sanitized title '{0}' is different from original title '{1}'".format(sanitized_title, title))
-
-                        if self.flg_hierarchy:
-                            pagepath = page.path
-                        else:
-                            pagepath = sanitized_title
-
-                        p = wt.page.Page(self.site, title=pagepath)
+                        # sanitized and free of collisions, see TitleIndex
+                        pagepath = self.titles.title(page)
                     except Exception as e:
-                        msg = "Exception creating page: {0}".format(e)
-                        print(msg)
-                        print(traceback.format_exc())
+                        log.exception("Exception creating page: %s", e)
                         flg_error = True
                     if not flg_error:
                         try:
-                            p.edit(
-                                text='%s%s%s' % (
-                                    page.towiki(),
-                                    self.get_files_list(page),
-                                    self.get_subpage_menu(page)
-                                ),
-                                skipmd5=True
+                            if text is None:
+                                text = page.towiki()
+                            text = '%s%s%s' % (
+                                text,
+                                self.get_files_list(page),
+                                self.get_subpage_menu(page)
                             )
-                            msg = "Wrote page: {0}".format(p.title)
-                            print(msg)
+                            if self.dump:
+                                self.dump.add_page(pagepath, text)
+                                log.debug("Dumped page: %s", pagepath)
+                            elif self.text_identical(pagepath, text):
+                                with self.lock:
+                                    self.identicalcount += 1
+                                log.debug("Already on the wiki: %s", pagepath)
+                            else:
+                                p = self.api(wt.page.Page, self.site, title=pagepath)
+                                self.api(p.edit, text=text, skipmd5=True)
+                                log.debug("Wrote page: %s", p.title)
+                            flg_done = True
                         except Exception as e:
-                            msg = "Exception during write: {0}".format(e)
-                            print(msg)
-                            print(traceback.format_exc())
+                            log.exception("Exception during write: %s", e)
             else:
-                msg = "ERROR: cannot write page, site is not open".format(self.site)
-                print(msg)
+                log.error("ERROR: cannot write page, site is not open")
+        return flg_done
+
+    def write(self, page, text=None):
+        if self.page_done(page):
+            page.release()
+            return
+        # the downloads run while the page is converted
+        self.prefetch_files(page)
+        if text is None and self.flg_copypages:
+            text = self.page_text(page)
+        flg_files = self.write_files(page)
+        if text is UNCHANGED:
+            with self.lock:
+                self.unchangedcount += 1
+            flg_done = True
+        else:
+            flg_done = self.write_page(page, text)
+        if not flg_files:
+            # left out of the journal so --resume tries its files again
+            log.warning("Files of page %s failed, not journaled", page.title)
+        # a dumped page is only done once the dump is imported, which the
+        # journal cannot see, so dump runs always write every page
+        if flg_done and flg_files and self.journal and not self.dump:
+            self.mark_page(page)
+        if self.progress:
+            self.progress.tick()
+        # the subpage menu only needs the titles, which stay in self.titles
+        page.release()
+
+    def mark_page(self, page):
+        """
+        journal the page, or wait for the batch holding its files
+        """
+        if self.dbconfig:
+            with self.dblock:
+                if page.id in self.failed_pages:
+                    return
+                if any(p is page for filedata, file, p in self.pending_files):
+                    self.pending_pages.append(page)
+                    return
+        self.journal_page(page)
+
+    def journal_page(self, page):
+        self.journal.mark_page(page.id, page.title)
+        self.save_page_state(page)
 
     def update_mainpage(self, root):
         if self.flg_copypages:
             if self.site:
     
-                p = wt.page.Page(self.site, title=self.main_page)
                 try:
-                    p.edit(text=root.title.replace(' ', '_'))
+                    if self.dump:
+                        self.dump.add_page(self.main_page, self.titles.title(root).replace(' ', '_'))
+                    else:
+                        p = self.api(wt.page.Page, self.site, title=self.main_page)
+                        self.api(p.edit, text=self.titles.title(root).replace(' ', '_'))
                 except Exception as e:
-                    print(e)
+                    log.error("Exception updating main page: %s", e)
             else:
-                msg = "ERROR: update main page, site is not open".format(self.site)
-                print(msg)
+                log.error("ERROR: update main page, site is not open")
 
     def create_from_mindtouch(self, root):
-        if self.debug:
-            msg = "Creating from mindtouch: {0}".format(root.title)
-            self.log_msg(msg)
-            msg = "Path: {0}".format(root.path)
-            self.log_msg(msg)
-            #msg = "page object: {0}".format(root)
-            #self.log_msg(msg)
+        log.debug("Creating from mindtouch: %s, path: %s", root.title, root.path)
+
+        # every title is known before the first page links to its subpages
+        self.titles.build(root)
+        self.load_digests(walk_pages(root))
+
+        if self.pipeline:
+            self.pipeline.run(self.with_file_info(walk_pages(root, self.traversal)))
+            return
+
+        self.write_tree(root)
+
+    def create_from_shard(self, root, plan, shard):
+        """
+        write only the pages the ShardPlan gives to shard, the titles and
+        subpage menus still cover the whole tree
+        """
+        self.titles.build(root)
+        pages = list(plan.walk(root, shard))
+        self.load_digests(pages)
+        self.create_from_pages(pages)
+
+    def coordinate_shards(self, root):
+        """
+        the pass after every shard is done. The shards link their subpage
+        menus to the final titles of the whole tree and MediaWiki updates
+        those links as the pages appear, so no page is written again,
+        only the titles are needed for update_mainpage
+        """
+        self.titles.build(root)
+
+    @staticmethod
+    def listed_files(pages):
+        """
+        the files of the pages whose attachment lists were fetched already
+        """
+        for page in pages:
+            if page.files_loaded():
+                yield from page.files
+
+    def with_file_info(self, pages):
+        """
+        pass pages on digest_batch_size at a time, after listing their
+        files at once and looking the titles up on the wiki in batches,
+        so write_files_api does not query the wiki page by page
+        """
+        if not (self.flg_copyfiles and self.flg_skip_identical and self.site) \
+                or self.dbconfig or self.dump:
+            yield from pages
+            return
+        window = list()
+        for page in pages:
+            window.append(page)
+            if len(window) >= self.digest_batch_size:
+                self.prepare_files(window)
+                yield from window
+                window = list()
+        self.prepare_files(window)
+        yield from window
+
+    def prepare_files(self, pages):
+        unlisted = [p for p in pages if not p.files_loaded()]
+        if unlisted and hasattr(unlisted[0].wiki, 'load_files'):
+            try:
+                unlisted[0].wiki.load_files(unlisted)
+            except Exception as e:
+                log.error("Exception listing files: %s", e)
+        self.load_file_info(self.listed_files(pages))
+
+    def write_tree(self, root):
+        """
+        write root and the pages below it without recursion, each page is
+        released after it is written so memory follows the width of the
+        tree, not its size
+        """
+        for page in self.with_file_info(walk_pages(root, self.traversal)):
+            self.write(page)
+
+    def create_from_pages(self, pages):
+        """
+        write the pages of an iterable as it produces them, for example
+        MTWiki.iter_sitemap() while the sitemap is still being parsed
+        """
+        pages = self.with_file_info(pages)
+        if self.pipeline:
+            self.pipeline.run(pages)
+            return
 
-        self.write(root)
-        for subpage in root.subpages:
-            self.create_from_mindtouch(subpage)
+        for page in pages:
+            log.debug("Creating from mindtouch: %s", page.title)
+            self.write(page)
 
     def done(self):
+        if self.downloads:
+            self.downloads.close()
+        if self.dump:
+            self.load_dump()
         if self.site:
             self.site.logout()
         if self.dbconfig:
+            with self.dblock:
+                self.flush_files_db()
             self.db.commit()
             self.db.close()
 
@@ -358,3 +946,27 @@ class MWWiki:
         self.log_msg(msg)
         msg = "File count: {0}".format(self.filecount)
         self.log_msg(msg)
+        if self.journal:
+            msg = "Skipped, already done: {0}".format(self.skipcount)
+            self.log_msg(msg)
+        if self.flg_incremental:
+            msg = "Unchanged pages: {0}".format(self.unchangedcount)
+            self.log_msg(msg)
+        if self.digests is not None:
+            msg = "Identical on the wiki, not edited: {0}".format(self.identicalcount)
+            self.log_msg(msg)
+        if self.remote_files:
+            msg = "Files already on the wiki, not uploaded: {0}".format(self.identicalfilecount)
+            self.log_msg(msg)
+        if self.cache:
+            msg = "Attachment cache hits: {0}, misses: {1}".format(
+                self.cache.hits, self.cache.misses)
+            self.log_msg(msg)
+            self.cache.close()
+        if self.conversion_cache:
+            msg = "Conversion cache hits: {0}, misses: {1}".format(
+                self.conversion_cache.hits, self.conversion_cache.misses)
+            self.log_msg(msg)
+            self.conversion_cache.close()
+        if self.journal:
+            self.journal.close()
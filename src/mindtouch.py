@@ -19,114 +19,251 @@
 
 
 # system library
-import urllib.request, urllib.error, urllib.parse
+import io
+import asyncio
+import threading
+import http.client
 import xml.etree.ElementTree as etree
 from xml.sax.saxutils import unescape
 
 # our library
 from page import HTMLPage, File
-from ansible.plugins.lookup import password
+from session import HTTPSession, AsyncHTTPSession, HTTPError
+from stats import stats
+from log import get_logger
+
+log = get_logger('mindtouch')
+
+def iter_pages(source, wiki):
+    """
+    parse a sitemap from a file like source while it is read and yield
+    each page as soon as its subpages are known, so subpages come before
+    their parent and the homepage comes last. Parsed elements are
+    dropped at once, the raw xml is never held in memory.
+    """
+    # per open <page>: [id, title, path, modified, subpages]
+    pages = list()
+    elems = list()
+    for event, elem in etree.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            elems.append(elem)
+            if elem.tag == 'page':
+                pages.append([elem.get('id'), None, None, None, list()])
+            continue
+        elems.pop()
+        if not pages:
+            continue
+        if elem.tag == 'title':
+            pages[-1][1] = elem.text
+        elif elem.tag == 'path':
+            pages[-1][2] = elem.text
+        elif elem.tag == 'date.modified':
+            pages[-1][3] = elem.text
+        elif elem.tag == 'page':
+            id, title, path, modified, subpages = pages.pop()
+            page = HTMLPage(id, title, wiki, path, modified)
+            for subpage in subpages:
+                page.add_subpage(subpage)
+            if pages:
+                pages[-1][4].append(page)
+            else:
+                page.path = page.title
+            elem.clear()
+            if elems:
+                elems[-1].remove(elem)
+            yield page
+
+
+def parse_content(data):
+    response = etree.fromstring(data)
+    text = response.find('body').text
+    if text:
+        return unescape(text.strip())
+    else:
+        return ""
+
+
+def parse_files(data, page, session=None):
+    response = etree.fromstring(data)
+    files = list()
+    for file in response.findall('file'):
+        contents = file.find('contents')
+        files.append(File(
+            file.find('filename').text,
+            contents.get('href'),
+            session,
+            contents.get('size'),
+            file.get('revision')
+        ))
+    page.set_files(files)
+
+
+class AsyncMTWiki:
+    """
+    asyncio MindTouch client, at most concurrency api requests are in
+    flight at once
+
+    The pages it parses belong to owner (the MTWiki wrapping it, or
+    itself) and their files are downloaded through filesession.
+    """
+
+    def __init__(self, baseurl, concurrency=32, poolsize=None, owner=None, filesession=None):
+        self.baseurl = baseurl
+        self.concurrency = max(1, concurrency)
+        self.session = AsyncHTTPSession(poolsize or self.concurrency)
+        self.owner = owner or self
+        self.filesession = filesession
+        # created on first use, inside the event loop
+        self.semaphore = None
+        self.homepage = None
+
+    async def login(self, username, password):
+        self.session.set_auth(self.baseurl, username, password)
+        await self.session.open(self.baseurl)
+
+    async def request(self, api_func):
+        url = '%s/@api/deki/%s' % (self.baseurl, api_func)
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+
+        log.debug("Requesting: %s", url)
+
+        async with self.semaphore:
+            with stats.timer('mindtouch.request'):
+                try:
+                    response = await self.session.open(url)
+                except HTTPError as e:
+                    log.error("Mindtouch request %s failed: %s %r", url, e.code, e.read())
+                    stats.count('mindtouch.errors')
+                    return None
+                except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                    log.error("Mindtouch request %s failed: %s", url, e)
+                    stats.count('mindtouch.errors')
+                    return None
+        if response.status != 200:
+            raise Exception('ERROR: Mindtouch api request failed')
+        stats.count('mindtouch.bytes', len(response.body))
+        return response.body
+
+    async def get_sitemap(self):
+        self.homepage = None
+        data = await self.request('pages')
+        if data:
+            for self.homepage in iter_pages(io.BytesIO(data), self.owner):
+                pass
+        return self.homepage
+
+    async def get_page_content(self, page):
+        return parse_content(await self.request('pages/%s/contents' % page.id))
+
+    async def set_page_files(self, page):
+        data = await self.request('pages/%s/files' % page.id)
+        if data:
+            parse_files(data, page, self.filesession)
+
+    async def load_files(self, pages):
+        """
+        list the files of many pages at once
+        """
+        await asyncio.gather(*(self.set_page_files(page) for page in pages
+                               if not page.files_loaded()))
+
+    async def close(self):
+        await self.session.close()
+
 
 class MTWiki:
-    def __init__(self, baseurl, username=None, password=None):
+    """
+    blocking MindTouch client
+
+    The api calls run on an AsyncMTWiki in a background event loop, so
+    the calls of all threads share its connections and its concurrency
+    limit. The sitemap stream and the file downloads use a blocking
+    HTTPSession.
+    """
+
+    def __init__(self, baseurl, username=None, password=None, poolsize=8, concurrency=None):
         self.baseurl = baseurl
-        self.debug = True
 
         self.username = username
         self.password = password
+        # keep-alive connections for the sitemap stream and file downloads
+        self.session = HTTPSession(poolsize)
+        self.aio = AsyncMTWiki(baseurl, concurrency or poolsize, poolsize,
+                               owner=self, filesession=self.session)
+        self.loop = None
+        self.lock = threading.Lock()
+        self.homepage = None
+
+    def run(self, coro):
+        """
+        run a coroutine on the background loop and wait for its result
+        """
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
         
     def login(self, username, password):
         
-        # create a password manager
-        password_mgr = urllib.request.HTTPPasswordMgrWithDefaultRealm()
+        # every request to the wiki host now carries the credentials
+        self.session.set_auth(self.baseurl, username, password)
 
-        # Add the username and password.
-        # If we knew the realm, we could use it instead of None.
+        # check them with one request
+        self.run(self.aio.login(username, password))
 
-        password_mgr.add_password(None, self.baseurl, username, password)
-
-        handler = urllib.request.HTTPBasicAuthHandler(password_mgr)
-
-        # create "opener" (OpenerDirector instance)
-        opener = urllib.request.build_opener(handler)
+    def request(self, api_func):
+        return self.run(self.aio.request(api_func))
 
-        # use the opener to fetch a URL
-        opener.open(self.baseurl)
+    def open(self, api_func):
+        """
+        like request, but return the response to read from, or None
+        """
+        url = '%s/@api/deki/%s' % (self.baseurl, api_func)
 
-        # Install the opener.
-        # Now all calls to urllib.request.urlopen use our opener.
-        urllib.request.install_opener(opener)
+        log.debug("Requesting: %s", url)
 
-    def request(self, api_func):
-        url = '%s/@api/deki/%s' % (self.baseurl, api_func)
-        
-        data = None
-        
-        if self.debug:
-            msg = "Requesting: {0}".format(url)
-            print(msg)
-        
         try:
-            response = urllib.request.urlopen(url)
-        except urllib.error.HTTPError as e:
-            print(e.code)
-            print(e.read())
-            success = False
-        except urllib.error.URLError as e:
-            print(e.reason) 
-            success = False
-        else:
-            success = True
-
-        if success:
-            if response.msg != 'OK':
-                raise Exception('ERROR: Mindtouch api request failed')
-            else:
-                data = response.read()
-        return data
-
-    @staticmethod
-    def generate_sitemap(root, wiki):
-        id = root.get('id')
-        title = root.find('title').text
-        path = root.find('path').text
-        page = HTMLPage(id, title, wiki, path)
-        wiki.set_page_files(page)
-        for subpage in root.find('subpages').findall('page'):
-            page.add_subpage(MTWiki.generate_sitemap(subpage, wiki))
-        return page
+            return self.session.open(url)
+        except HTTPError as e:
+            log.error("Mindtouch request %s failed: %s %r", url, e.code, e.read())
+        except (OSError, http.client.HTTPException) as e:
+            log.error("Mindtouch request %s failed: %s", url, e)
+        return None
+
+    def iter_sitemap(self):
+        """
+        stream the page tree, see iter_pages, homepage is set once the
+        last page was taken
+        """
+        response = self.open('pages')
+        if response is None:
+            return
+        homepage = None
+        with response:
+            for homepage in iter_pages(response, self):
+                yield homepage
+        self.homepage = homepage
 
     def get_sitemap(self):
-        data = self.request('pages')
-        
-        if data:
-            root = etree.fromstring(data).find('page')
-            self.homepage = self.generate_sitemap(root, self)
-            self.homepage.path = self.homepage.title
-            return self.homepage
-        else:
-            return None
+        self.homepage = None
+        for page in self.iter_sitemap():
+            pass
+        return self.homepage
 
     def get_page_content(self, page):
-        response = etree.fromstring(
-            self.request('pages/%s/contents' % page.id)
-        )
-        text = response.find('body').text
-        if text:
-            return unescape(text.strip())
-        else:
-            return ""
+        return self.run(self.aio.get_page_content(page))
 
     def set_page_files(self, page):
-        
-        data = self.request('pages/%s/files' % page.id)
-        if data:
-            response = etree.fromstring(data)          
-    
-            files = response.findall('file');
-            for file in files:
-                page.add_file(File(
-                    file.find('filename').text,
-                    file.find('contents').get('href')
-                ))
+        self.run(self.aio.set_page_files(page))
+
+    def load_files(self, pages):
+        self.run(self.aio.load_files(pages))
 
+    def close(self):
+        if self.loop is not None:
+            self.run(self.aio.close())
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop = None
+        self.session.close()
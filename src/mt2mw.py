@@ -4,12 +4,27 @@
 # File: mt2mw.py
 #
 # system library
+import os
 import sys
+import argparse
 import configparser as cp
 
 # our library
 from mindtouch import MTWiki
 from mediawiki import MWWiki
+from page import configure_converter, configure_conversion_cache
+from converter import converter_version
+from pipeline import PagePipeline
+from journal import Journal
+from download import DownloadPool
+from cache import AttachmentCache, ConversionCache
+from ratelimit import RateLimiter
+from xmldump import XMLDumpWriter
+from stats import stats, Progress
+from log import get_logger, configure_logging, stop_logging
+from shard import ShardPlan, parse_shard
+
+log = get_logger('mt2mw')
 
 
 class mt2mwapp(object):
@@ -29,6 +44,17 @@ class mt2mwapp(object):
         self.configfile = 'config.ini'
         self.cfg = None
         self.flg_mtlogin = True
+        # skip the pages and files finished by an earlier run
+        self.flg_resume = False
+        # only write what changed since the last run
+        self.flg_incremental = False
+        # overrides log_level from the config file when set
+        self.log_level = None
+        self.log_file = None
+        # (i, N) to migrate only shard i of N, see shard.py
+        self.shard = None
+        # N for the final pass over a run split into N shards
+        self.coordinate = None
         
     def configure(self):
         """
@@ -41,6 +67,15 @@ class mt2mwapp(object):
         cfg.read(self.configfile)
         self.cfg = cfg
         
+    def shard_path(self, path):
+        """
+        a per shard name for files that shards on one host would share
+        """
+        if not self.shard:
+            return path
+        base, ext = os.path.splitext(path)
+        return '{0}.shard{1}{2}'.format(base, self.shard[0], ext)
+
     def migratewiki(self):
         """
         Migrate mindtouch wiki to mediawiki
@@ -48,17 +83,43 @@ class mt2mwapp(object):
         """
         
         cfg = self.cfg
+
+        configure_logging(
+            self.log_level or cfg.get('config', 'log_level', fallback='info'),
+            self.log_file or cfg.get('config', 'log_file', fallback=None),
+        )
         
         # get the root element in the page structure
-        print("Attempting to get the mindtouch wiki layout")
+        log.info("Attempting to get the mindtouch wiki layout")
         mtuser = cfg.get('config', 'mindtouch_user')
         mtpassword = cfg.get('config', 'mindtouch_password')
-        mtwiki = MTWiki(cfg.get('config', 'mindtouch_url'))
+        mtwiki = MTWiki(
+            cfg.get('config', 'mindtouch_url'),
+            poolsize=cfg.getint('config', 'mindtouch_pool_size', fallback=8),
+            concurrency=cfg.getint('config', 'mindtouch_concurrency', fallback=16),
+        )
         if mtuser and self.flg_mtlogin:
             mtwiki.login(mtuser, mtpassword)
-        homepage = mtwiki.get_sitemap()
-        if homepage:
-            print("Have mindtouch layout.")
+        # stream the layout: pages are written while it is still parsed
+        flg_stream = cfg.getboolean('config', 'stream_sitemap', fallback=False)
+        flg_sharded = bool(self.shard or self.coordinate)
+        if flg_sharded and flg_stream:
+            log.warning("stream_sitemap is ignored, sharding needs the whole layout")
+            flg_stream = False
+        homepage = None
+        if not flg_stream:
+            homepage = mtwiki.get_sitemap()
+            if homepage:
+                log.info("Have mindtouch layout.")
+
+        plan = None
+        if self.shard and homepage:
+            if cfg.getboolean('config', 'shard_count_files', fallback=False):
+                # weigh the pages by their attachments too
+                mtwiki.load_files(list(PagePipeline.walk(homepage)))
+            plan = ShardPlan(homepage, self.shard[1],
+                cfg.getfloat('config', 'shard_file_weight', fallback=1.0))
+            log.info("Shards: %s", plan.summary())
         
         directdb = cfg.get('config', 'direct_db')
         dbconfig = None
@@ -66,6 +127,15 @@ class mt2mwapp(object):
         flg_copypages = cfg.getboolean('config', 'copypages',fallback=True)
         flg_showsubpages = cfg.getboolean('config', 'showsubpages',fallback=True)
 
+        # number of persistent convert.pl processes, or the native engine
+        converter_engine = cfg.get('config', 'converter_engine', fallback='perl')
+        configure_converter(
+            cfg.getint('config', 'converter_workers', fallback=1),
+            converter_engine,
+            cfg.get('config', 'mindtouch_url'),
+            cfg.getboolean('config', 'converter_fallback', fallback=True),
+        )
+
         if directdb:
             dbconfig = {
                 'host': cfg.get('config', 'mediawiki_db_host'),
@@ -74,10 +144,10 @@ class mt2mwapp(object):
                 'user': cfg.get('config', 'mediawiki_db_user'),
                 'password': cfg.get('config', 'mediawiki_db_password'),
             }
-            print("Will use DB connection")
+            log.info("Will use DB connection")
         
-        print("Attempting to create mediawiki connection")
-        print("Copying files: {0}, Copying pages: {1}".format(flg_copyfiles, flg_copypages))
+        log.info("Attempting to create mediawiki connection")
+        log.info("Copying files: %s, Copying pages: %s", flg_copyfiles, flg_copypages)
         
         mwwiki = MWWiki(
             cfg.get('config', 'mediawiki_url'),
@@ -87,20 +157,107 @@ class mt2mwapp(object):
             cfg.get('config', 'dataroot'),
         )
         if mwwiki:
-            print("MediaWiki Connection created")
+            log.info("MediaWiki Connection created")
             mwwiki.set_copyfiles(flg_copyfiles)
             mwwiki.set_copypages(flg_copypages)
             mwwiki.set_showsubpages(flg_showsubpages)
+            mwwiki.set_limiter(RateLimiter(
+                cfg.getfloat('config', 'api_rate', fallback=0),
+                cfg.getint('config', 'api_burst', fallback=10),
+                cfg.getint('config', 'api_retries', fallback=5),
+            ))
+            mwwiki.set_file_batch_size(cfg.getint('config', 'file_batch_size', fallback=100))
+            mwwiki.set_downloads(DownloadPool(
+                cfg.getint('config', 'download_workers', fallback=4)))
+            mwwiki.set_upload_by_url(
+                cfg.getboolean('config', 'upload_by_url', fallback=False))
+            if cfg.has_option('config', 'staging_dir'):
+                mwwiki.set_staging(cfg.get('config', 'staging_dir'))
+            if cfg.get('config', 'output', fallback='api') == 'xmldump':
+                mwwiki.set_dump(
+                    XMLDumpWriter(
+                        self.shard_path(cfg.get('config', 'dump_file', fallback='mt2mw-dump.xml')),
+                        cfg.get('config', 'mediawiki_user'),
+                        cfg.getint('config', 'dump_pages_per_file', fallback=0),
+                    ),
+                    cfg.get('config', 'dump_import', fallback='none'),
+                    cfg.get('config', 'import_command', fallback=None),
+                    cfg.get('config', 'import_interwiki_prefix', fallback='mindtouch'),
+                )
+            convcache = cfg.get('config', 'conversion_cache', fallback='')
+            if convcache:
+                convcache = ConversionCache(convcache,
+                    converter_version(engine=converter_engine,
+                        base_uri=cfg.get('config', 'mindtouch_url')),
+                    cfg.getint('config', 'conversion_cache_entries', fallback=100000))
+                configure_conversion_cache(convcache)
+                mwwiki.set_conversion_cache(convcache)
+            cachedir = cfg.get('config', 'cache_dir', fallback='')
+            if cachedir:
+                mwwiki.set_cache(AttachmentCache(cachedir,
+                    cfg.getint('config', 'cache_size_mb', fallback=10240) * 1024 * 1024))
+            # the coordinator writes no pages, the shard journals are left alone
+            if not self.coordinate:
+                journalfile = self.shard_path(cfg.get('config', 'journal_file',
+                    fallback=Journal.default_path()))
+                journal = Journal(journalfile)
+                if self.flg_resume:
+                    log.info("Resuming from journal %s", journalfile)
+                else:
+                    journal.reset()
+                mwwiki.set_journal(journal)
+            mwwiki.set_incremental(self.flg_incremental
+                or cfg.getboolean('config', 'incremental', fallback=False))
+            mwwiki.set_skip_identical(
+                cfg.getboolean('config', 'skip_identical', fallback=True),
+                cfg.getint('config', 'digest_batch_size', fallback=50))
+            mwwiki.set_traversal(cfg.get('config', 'traversal_order', fallback='dfs'))
+            if cfg.getboolean('config', 'pipeline', fallback=False):
+                mwwiki.set_pipeline(PagePipeline(
+                    mwwiki,
+                    cfg.getint('config', 'fetch_workers', fallback=4),
+                    cfg.getint('config', 'convert_workers', fallback=2),
+                    cfg.getint('config', 'write_workers', fallback=2),
+                    cfg.getint('config', 'pipeline_queue_size', fallback=32),
+                ))
         
-        print("Creating MediaWiki from mindtouch site...")
-        mwwiki.create_from_mindtouch(homepage)
-        print("MediaWiki updated")
+        # the page count is only known up front when the layout is loaded
+        total = None
+        if plan and self.shard:
+            total = plan.pages[self.shard[0] - 1]
+        elif homepage:
+            total = sum(1 for p in PagePipeline.walk(homepage))
+        mwwiki.set_progress(Progress(total,
+            cfg.getint('config', 'progress_interval', fallback=10)))
+
+        log.info("Creating MediaWiki from mindtouch site...")
+        if self.coordinate:
+            log.info("Coordinating shards")
+            if homepage:
+                mwwiki.coordinate_shards(homepage)
+        elif plan:
+            log.info("Migrating shard %d/%d", self.shard[0], self.shard[1])
+            mwwiki.create_from_shard(homepage, plan, self.shard[0])
+        elif flg_stream:
+            mwwiki.create_from_pages(mtwiki.iter_sitemap())
+            homepage = mtwiki.homepage
+        else:
+            mwwiki.create_from_mindtouch(homepage)
+        log.info("MediaWiki updated")
         
-        # point MediaWiki:MainPage at the new homepage
-        print("Updating MediaWiki homepage")
-        mwwiki.update_mainpage(homepage)
+        # point MediaWiki:MainPage at the new homepage, once per site:
+        # sharded runs leave it to the coordinator pass
+        if not self.shard:
+            log.info("Updating MediaWiki homepage")
+            mwwiki.update_mainpage(homepage)
         mwwiki.done()
-        print("All done!")
+        mtwiki.close()
+        reportfile = cfg.get('config', 'report_file', fallback='')
+        if reportfile:
+            stats.write_report(reportfile)
+            log.info("Run report written to %s", reportfile)
+        log.info("All done!")
+        stop_logging()
 
     def main_cli(self, argv):
         """
@@ -108,6 +265,33 @@ class mt2mwapp(object):
         Main entry point
         """
 
+        parser = argparse.ArgumentParser(description='Migrate a MindTouch wiki to MediaWiki')
+        parser.add_argument('--resume', action='store_true',
+            help='skip pages and files finished by an earlier run')
+        parser.add_argument('--incremental', action='store_true',
+            help='only write pages and files that changed since the last run')
+        parser.add_argument('--log-level',
+            choices=['debug', 'info', 'warning', 'error'],
+            help='log level, overrides log_level in config.ini')
+        parser.add_argument('-v', '--verbose', dest='log_level',
+            action='store_const', const='debug', help='same as --log-level debug')
+        parser.add_argument('-q', '--quiet', dest='log_level',
+            action='store_const', const='warning', help='same as --log-level warning')
+        parser.add_argument('--log-file', help='also write the log to this file')
+        parser.add_argument('--shard', metavar='i/N', type=parse_shard,
+            help='migrate only shard i of N, one process per shard, on any hosts')
+        parser.add_argument('--coordinate', action='store_true',
+            help='after all shards are done: update the main page')
+        args = parser.parse_args(argv[1:])
+        if args.shard and args.coordinate:
+            parser.error('--shard and --coordinate exclude each other')
+        self.flg_resume = args.resume
+        self.flg_incremental = args.incremental
+        self.log_level = args.log_level
+        self.log_file = args.log_file
+        self.shard = args.shard
+        self.coordinate = args.coordinate
+
         # load configuration
         self.configure()
         # run the migration process
@@ -17,40 +17,175 @@
 
 # system library
 import os
-import subprocess as sp
+import sys
+import atexit
 import urllib.request, urllib.error, urllib.parse
 import mimetypes
+import tempfile
+import hashlib
+import struct
+import collections
 from datetime import datetime, tzinfo
 import psycopg2 as pg
 import re
 
+# our library
+from converter import ConverterPool
+from htmlwiki import NativeConverter
+from stats import stats
+
+# read size for streaming downloads
+CHUNK_SIZE = 1024 * 1024
+# bytes kept from the start of a download to find the image dimensions
+HEADER_SIZE = 64 * 1024
+
+def sha1_base36(hexdigest):
+    """
+    sha1 the way MediaWiki stores it in img_sha1: base 36, 31 digits
+    """
+    n = int(hexdigest, 16)
+    digits = ''
+    while n:
+        n, d = divmod(n, 36)
+        digits = '0123456789abcdefghijklmnopqrstuvwxyz'[d] + digits
+    return digits.rjust(31, '0')
+
+def image_size(header):
+    """
+    (width, height, bits) from the first bytes of a PNG, GIF or JPEG
+    file, zeros for anything else
+    """
+    if header[:8] == b'\x89PNG\r\n\x1a\n' and len(header) >= 25:
+        width, height = struct.unpack('>II', header[16:24])
+        return width, height, header[24]
+    if header[:6] in (b'GIF87a', b'GIF89a') and len(header) >= 11:
+        width, height = struct.unpack('<HH', header[6:10])
+        return width, height, (header[10] & 0x07) + 1
+    if header[:2] == b'\xff\xd8':
+        pos = 2
+        while pos + 9 < len(header):
+            if header[pos] != 0xff:
+                break
+            marker = header[pos + 1]
+            if marker == 0xff:
+                pos += 1
+                continue
+            length = struct.unpack('>H', header[pos + 2:pos + 4])[0]
+            # start of frame markers, except DHT, JPG and DAC
+            if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                bits = header[pos + 4]
+                height, width = struct.unpack('>HH', header[pos + 5:pos + 9])
+                return width, height, bits
+            pos += 2 + length
+    return 0, 0, 0
+
+def intern(s):
+    """
+    share one copy of repeated titles and paths across the tree
+    """
+    return sys.intern(s) if isinstance(s, str) else s
+
 class File:
-    def __init__(self, title, url):
-        self.title = title.capitalize().replace(' ', '_')
+    # a big wiki has hundreds of thousands of these
+    __slots__ = (
+        'title', 'url', 'size', 'revision', 'session', 'path',
+        'sha1', 'filesize', 'width', 'height', 'bits',
+    )
+
+    def __init__(self, title, url, session=None, size=None, revision=None):
+        self.title = intern(title.capitalize().replace(' ', '_'))
         self.url = url
-        self.debug = True
+        # as reported by the source wiki, used to detect changed files
+        self.size = size
+        self.revision = revision
+        # pooled HTTPSession of the source wiki, None to use urlopen
+        self.session = session
+        # filled in by download_to
+        self.path = None
+        self.sha1 = ''
+        self.filesize = 0
+        self.width = 0
+        self.height = 0
+        self.bits = 0
+
+    def cache_key(self):
+        """
+        names this version of the file in the AttachmentCache, None when
+        the source gave no revision or size to tell versions apart
+        """
+        if self.revision is None and self.size is None:
+            return None
+        key = '{0}\0{1}\0{2}'.format(self.url, self.revision, self.size)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
 
-    def download_to(self, path):
+    def download_to(self, path, cache=None):
+        """
+        stream the file to path in CHUNK_SIZE pieces, the data goes to a
+        temporary file first so path never holds a partial download.
+        With a cache the file is taken from it when possible and stored
+        in it otherwise.
+        """
+        key = cache and self.cache_key()
+        if key and cache.get(key, self, path):
+            stats.count('download.cache_hits')
+            return
+        with stats.timer('download'):
+            self.fetch_to(path)
+        stats.count('download.bytes', self.filesize)
+        if key:
+            cache.put(key, self)
+
+    def fetch_to(self, path):
+        """
+        stream the file from the source wiki to path
+        """
         self.path = path
         dir = os.path.dirname(path)
         if not os.path.exists(dir):
-            os.makedirs(dir)
-        dl = urllib.request.urlopen(self.url)
-        f = open(path, 'wb')
-        f.write(dl.read())
-        f.close()
+            os.makedirs(dir, exist_ok=True)
+        if self.session:
+            dl = self.session.open(self.url)
+        else:
+            dl = urllib.request.urlopen(self.url)
+        fd, tmppath = tempfile.mkstemp(dir=dir, prefix='.download-')
+        # hash, size and image header are taken from the chunks as they
+        # are written, get_info never reads the file back
+        sha1 = hashlib.sha1()
+        size = 0
+        header = b''
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = dl.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    sha1.update(chunk)
+                    size += len(chunk)
+                    if len(header) < HEADER_SIZE:
+                        header += chunk[:HEADER_SIZE - len(header)]
+            os.chmod(tmppath, 0o644)
+            os.replace(tmppath, path)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+        finally:
+            dl.close()
+        self.sha1 = sha1_base36(sha1.hexdigest())
+        self.filesize = size
+        self.width, self.height, self.bits = image_size(header)
 
     def get_info(self):
         data = dict()
         data['name'] = self.title
         data['metadata'] = ''
         data['description'] = ''
-        data['size'] = os.path.getsize(self.path)
-        data['sha1'] = ''
+        data['size'] = self.filesize
+        data['sha1'] = self.sha1
         data['timestamp'] = datetime.now(pg.tz.LocalTimezone()) 
-        data['width'] = 0
-        data['height'] = 0
-        data['bits'] = 0
+        data['width'] = self.width
+        data['height'] = self.height
+        data['bits'] = self.bits
         mime = mimetypes.guess_type(self.path)[0]
         if mime:
             bits = mime.split('/')
@@ -68,23 +203,58 @@ class File:
 
 
 class HTMLPage:
-    def __init__(self, id, title, wiki, path):
+    __slots__ = ('id', 'title', 'wiki', 'path', 'modified', 'subpages', '_files')
+
+    def __init__(self, id, title, wiki, path, modified=None):
         self.id = id
-        self.title = title
+        self.title = intern(title)
         self.wiki = wiki
-        self.path = path
-        self.subpages = list()
-        self.files = list()
+        self.path = intern(path)
+        # last modification time reported by the source wiki, if any
+        self.modified = modified
+        # leaves share the empty tuple, a list is made on the first add
+        self.subpages = ()
+        # the attachment list costs one request per page, it is only
+        # fetched when something asks for it
+        self._files = None
+
+    @property
+    def files(self):
+        if self._files is None:
+            self.load_files()
+        return self._files
+
+    def load_files(self):
+        self._files = ()
+        self.wiki.set_page_files(self)
+
+    def files_loaded(self):
+        return self._files is not None
+
+    def set_files(self, files):
+        self._files = list(files) if files else ()
 
     def add_subpage(self, page):
+        if not self.subpages:
+            self.subpages = list()
         self.subpages.append(page)
 
     def add_file(self, file):
-        self.files.append(file)
+        if not self._files:
+            self._files = list()
+        self._files.append(file)
 
     def get_content(self):
         return self.wiki.get_page_content(self)
 
+    def release(self):
+        """
+        drop the subpages and attachments once the page is written, the
+        rest of the tree is then only held by the traversal
+        """
+        self.subpages = ()
+        self._files = ()
+
     def get_files(self):
         return self.wiki.get_page_files(self)
 
@@ -96,19 +266,108 @@ def reducechars(m):
     match = m.group()
     return match[:3] + match[-3:]
 
-def html2wiki(html):
-    
-    htmldata = html.encode()
-    cmd = os.path.join(os.getcwd(), 'convert.pl')
-    converter = sp.Popen(cmd, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, shell=True)
-    out, err = converter.communicate(input=htmldata)
-    if err:
-        raise Exception(err)
-    
-    if isinstance(out, (bytes, bytearray)):
-        outstr = out.decode()
-    else:
-        outstr = out
-
-    return outstr
+ENGINES = ('perl', 'native')
+# page tree traversals, see walk_pages
+ORDERS = ('dfs', 'bfs')
+
+def walk_pages(root, order='dfs'):
+    """
+    yield root and every page below it, parents before their subpages,
+    depth first (the sitemap order) or breadth first. The subpages of a
+    page are taken before it is yielded, so it may be released then.
+    """
+    if order not in ORDERS:
+        raise ValueError('unknown traversal order: {0}'.format(order))
+    pending = collections.deque([root])
+    while pending:
+        if order == 'bfs':
+            page = pending.popleft()
+            pending.extend(page.subpages)
+        else:
+            page = pending.pop()
+            pending.extend(reversed(page.subpages))
+        yield page
+
+_converter = None
+_converter_workers = 1
+_converter_engine = 'perl'
+_converter_uri = None
+_converter_fallback = True
+_fallback = None
+
+def configure_converter(workers=1, engine='perl', uri=None, fallback=True):
+    """
+    choose the html2wiki engine: 'perl' runs workers persistent convert.pl
+    processes, 'native' converts in process (htmlwiki.py) with links
+    below uri made internal, and hands the pages it fails on to
+    convert.pl when fallback is set
+    """
+    global _converter, _converter_workers, _converter_engine
+    global _converter_uri, _converter_fallback
+    if engine not in ENGINES:
+        raise ValueError('unknown converter engine: {0}'.format(engine))
+    _converter_workers = workers
+    _converter_engine = engine
+    _converter_uri = uri
+    _converter_fallback = fallback
+    close_converter()
+    _converter = None
+
+def converter_settings():
+    """
+    the configure_converter arguments after workers, for worker processes
+    """
+    return (_converter_engine, _converter_uri, _converter_fallback)
+
+def get_fallback():
+    global _fallback
+    if _fallback is None or _fallback.pid != os.getpid():
+        _fallback = ConverterPool(workers=1)
+    return _fallback
+
+def get_converter():
+    global _converter
+    # a forked child must not share the parent's pipes
+    if _converter is None or _converter.pid != os.getpid():
+        if _converter_engine == 'native':
+            _converter = NativeConverter(_converter_uri, _converter_uri,
+                get_fallback if _converter_fallback else None)
+        else:
+            _converter = ConverterPool(workers=_converter_workers)
+    return _converter
+
+@atexit.register
+def close_converter():
+    global _fallback
+    if _converter and _converter.pid == os.getpid():
+        _converter.close()
+    if _fallback and _fallback.pid == os.getpid():
+        _fallback.close()
+        _fallback = None
+
+_conversion_cache = None
+
+def configure_conversion_cache(cache):
+    """
+    put a ConversionCache in front of html2wiki, None to turn it off
+    """
+    global _conversion_cache
+    _conversion_cache = cache
+
+def convert_html(html):
+    """
+    convert without the cache, this is what runs in pipeline workers
+    """
+    return get_converter().convert(html)
 
+def html2wiki(html, convert=convert_html):
+    cache = _conversion_cache
+    if cache:
+        text = cache.get(html)
+        if text is not None:
+            return text
+    with stats.timer('convert'):
+        text = convert(html)
+    if cache:
+        cache.put(html, text)
+    return text
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+#
+# File: parity.py
+#
+# mt2mw -- package for migrating a Mindtouch wiki to MediaWiki
+# Copyright (C) 2010 Catalyst IT Ltd
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+compare the converter engines on the corpus in parity/
+
+Each parity/NAME.html has the expected wikitext in parity/NAME.wiki.
+
+    python parity.py                  native engine against the corpus
+    python parity.py --engine perl    convert.pl against the corpus
+    python parity.py --engine both    native engine against convert.pl
+    python parity.py --update         rewrite the .wiki files
+
+convert.pl takes its base url from mindtouch_url in config.ini, set it
+to the --uri used here (http://wiki.example.com/) for the links to match.
+"""
+
+# system library
+import sys
+import os
+import glob
+import argparse
+import difflib
+
+# our library
+from htmlwiki import html2wiki
+from converter import ConverterPool
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parity')
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Compare the html2wiki engines')
+    parser.add_argument('--engine', choices=['native', 'perl', 'both'], default='native')
+    parser.add_argument('--uri', default='http://wiki.example.com/',
+        help='base and wiki uri of the native engine')
+    parser.add_argument('--update', action='store_true',
+        help='store the native output as the expected wikitext')
+    parser.add_argument('names', nargs='*', help='corpus entries, default all')
+    args = parser.parse_args(argv[1:])
+
+    names = args.names or sorted(
+        os.path.splitext(os.path.basename(path))[0]
+        for path in glob.glob(os.path.join(CORPUS, '*.html')))
+    perl = ConverterPool() if args.engine in ('perl', 'both') else None
+
+    failed = 0
+    for name in names:
+        with open(os.path.join(CORPUS, name + '.html'), encoding='utf-8') as f:
+            html = f.read()
+        expected_path = os.path.join(CORPUS, name + '.wiki')
+        native = html2wiki(html, args.uri, args.uri)
+        if args.update:
+            with open(expected_path, 'w', encoding='utf-8') as f:
+                f.write(native + '\n')
+            print("Updated {0}".format(name))
+            continue
+
+        if args.engine == 'native':
+            got, want, labels = native, None, ('expected', 'native')
+        elif args.engine == 'perl':
+            got, want, labels = perl.convert(html), None, ('expected', 'convert.pl')
+        else:
+            got, want, labels = native, perl.convert(html), ('convert.pl', 'native')
+        if want is None:
+            with open(expected_path, encoding='utf-8') as f:
+                want = f.read()
+        got = got.strip()
+        want = want.strip()
+        if got == want:
+            print("ok      {0}".format(name))
+            continue
+        failed += 1
+        print("DIFFERS {0}".format(name))
+        sys.stdout.writelines(difflib.unified_diff(
+            want.splitlines(True), got.splitlines(True), labels[0], labels[1]))
+        print()
+
+    if perl:
+        perl.close()
+    if failed:
+        print("{0} of {1} differ".format(failed, len(names)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,160 @@
+#
+# File: pipeline.py
+#
+# mt2mw -- package for migrating a Mindtouch wiki to MediaWiki
+# Copyright (C) 2010 Catalyst IT Ltd
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# system library
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# our library
+from page import html2wiki, convert_html, configure_converter, converter_settings, walk_pages
+from mediawiki import UNCHANGED
+from log import get_logger
+
+log = get_logger('pipeline')
+
+# marks the end of the work for one stage
+DONE = object()
+
+
+class PagePipeline:
+    """
+    staged page migration: fetch -> convert -> write
+
+    Each stage has its own worker count and is connected to the next one
+    by a bounded queue, so a slow stage blocks the ones in front of it
+    instead of letting fetched pages pile up in memory.
+    """
+
+    def __init__(self, wiki, fetch_workers=4, convert_workers=2,
+                 write_workers=2, queue_size=32):
+        self.wiki = wiki
+        self.fetch_workers = max(1, fetch_workers)
+        self.convert_workers = max(1, convert_workers)
+        self.write_workers = max(1, write_workers)
+        self.queue_size = max(1, queue_size)
+
+    @staticmethod
+    def walk(root, order='dfs'):
+        """
+        yield the pages of the tree, parents before their subpages
+        """
+        return walk_pages(root, order)
+
+    def start_stage(self, func, inq, workers):
+        threads = list()
+        for i in range(workers):
+            t = threading.Thread(target=self.stage_loop, args=(func, inq))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        return threads
+
+    @staticmethod
+    def stage_loop(func, inq):
+        while True:
+            item = inq.get()
+            if item is DONE:
+                break
+            try:
+                func(*item)
+            except Exception as e:
+                log.exception("Exception in pipeline: %s", e)
+
+    @staticmethod
+    def finish_stage(threads, inq):
+        for t in threads:
+            inq.put(DONE)
+        for t in threads:
+            t.join()
+
+    def run(self, pages):
+        """
+        migrate every page of an iterable, e.g. walk(root) or
+        MTWiki.iter_sitemap()
+        """
+        wiki = self.wiki
+        fetchq = queue.Queue(self.queue_size)
+        convertq = queue.Queue(self.queue_size)
+        writeq = queue.Queue(self.queue_size)
+
+        def fetch(page):
+            if wiki.page_done(page):
+                page.release()
+                return
+            html = None
+            if wiki.get_copyfiles() or wiki.get_copypages():
+                # list the attachments here so the listing requests run
+                # in parallel instead of in the write stage
+                try:
+                    if not page.files_loaded():
+                        page.load_files()
+                    # the downloads overlap the conversion stage
+                    wiki.prefetch_files(page)
+                except Exception as e:
+                    log.error("Exception listing files of %s: %s", page.title, e)
+            if wiki.get_copypages():
+                if wiki.page_unchanged(page):
+                    writeq.put((page, UNCHANGED))
+                    return
+                try:
+                    html = page.get_content()
+                except Exception as e:
+                    log.error("Exception fetching page %s: %s", page.title, e)
+                if html is not None and wiki.page_unchanged(page, html):
+                    writeq.put((page, UNCHANGED))
+                    return
+            convertq.put((page, html))
+
+        def convert(page, html):
+            text = None
+            if html is not None:
+                try:
+                    # cache lookups stay in this process, misses go to the pool
+                    text = html2wiki(html, lambda h: pool.submit(convert_html, h).result())
+                except Exception as e:
+                    log.error("Exception converting page %s: %s", page.title, e)
+            writeq.put((page, text))
+
+        def write(page, text):
+            # text is None when an earlier stage failed, write() will then
+            # fetch and convert the page itself and report the error
+            wiki.write(page, text)
+
+        # spawn rather than fork, the pipeline threads are already running
+        pool = ProcessPoolExecutor(
+            self.convert_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=configure_converter, initargs=(1,) + converter_settings()
+        )
+        try:
+            fetchers = self.start_stage(fetch, fetchq, self.fetch_workers)
+            converters = self.start_stage(convert, convertq, self.convert_workers)
+            writers = self.start_stage(write, writeq, self.write_workers)
+
+            for page in pages:
+                fetchq.put((page,))
+
+            self.finish_stage(fetchers, fetchq)
+            self.finish_stage(converters, convertq)
+            self.finish_stage(writers, writeq)
+        finally:
+            pool.shutdown()
@@ -0,0 +1,135 @@
+#
+# File: ratelimit.py
+#
+# mt2mw -- package for migrating a Mindtouch wiki to MediaWiki
+# Copyright (C) 2010 Catalyst IT Ltd
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# system library
+import re
+import threading
+import time
+
+# our library
+from stats import stats
+
+# api error codes that mean "slow down and try again"
+RETRY_CODES = ('maxlag', 'ratelimited', 'readonly')
+RETRY_STATUS = (429, 502, 503, 504)
+
+
+class RateLimiter:
+    """
+    token bucket shared by every MediaWiki api call
+
+    Tokens refill at the current rate up to burst. An error the server
+    wants retried halves the rate and pauses all callers, for the
+    Retry-After or maxlag time if the server gave one, else for an
+    exponentially growing delay. Each success raises the rate again
+    until it is back at the configured one. A rate of 0 does not pace
+    the calls, they only pause and retry when the server asks.
+    """
+
+    def __init__(self, rate=0, burst=10, retries=5, max_delay=120):
+        self.unlimited = rate <= 0
+        self.max_rate = max(float(rate), 0.01)
+        self.min_rate = min(self.max_rate, 0.1)
+        self.rate = self.max_rate
+        self.burst = max(1, burst)
+        self.retries = retries
+        self.max_delay = max_delay
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        wait for a token
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.unlimited:
+                    return
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.rate = min(self.max_rate, self.rate * 1.1)
+
+    def failure(self, delay=None):
+        with self.lock:
+            self.failures += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            if delay is None:
+                delay = 2 ** self.failures
+            delay = min(delay, self.max_delay)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+
+    @staticmethod
+    def retry_delay(e):
+        """
+        (retry, delay) for an exception raised by an api call
+        """
+        headers = getattr(e, 'headers', None)
+        retryafter = headers.get('Retry-After') if headers else None
+        if retryafter and retryafter.isdigit():
+            return True, int(retryafter)
+        code = getattr(e, 'code', None)
+        if isinstance(code, int):
+            return code in RETRY_STATUS, None
+        if isinstance(e, OSError):
+            # connection refused, reset or timed out
+            return True, None
+        text = str(e)
+        if any(name in text for name in RETRY_CODES):
+            # "Waiting for db: 7 seconds lagged"
+            lag = re.search(r'(\d+(?:\.\d+)?) seconds? lagged', text)
+            return True, float(lag.group(1)) if lag else None
+        return False, None
+
+    def call(self, func, *args, **kwargs):
+        """
+        func(*args, **kwargs) within the rate, retried while the server
+        asks for it
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                retry, delay = self.retry_delay(e)
+                if not retry or attempt >= self.retries:
+                    raise
+                self.failure(delay)
+                stats.count('mediawiki.retries')
+                attempt += 1
+                continue
+            self.success()
+            return result
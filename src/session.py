@@ -0,0 +1,439 @@
+#
+# File: session.py
+#
+# mt2mw -- package for migrating a Mindtouch wiki to MediaWiki
+# Copyright (C) 2010 Catalyst IT Ltd
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# system library
+import ssl
+import base64
+import asyncio
+import email.parser
+import http.client
+import threading
+import urllib.parse
+import urllib.request
+
+# our library
+from stats import stats
+
+# statuses that carry a Location to follow
+REDIRECTS = (301, 302, 303, 307, 308)
+
+
+class HTTPError(Exception):
+    """
+    the server answered with an error status
+    """
+
+    def __init__(self, url, code, reason, body):
+        super(HTTPError, self).__init__('HTTP {0} {1}: {2}'.format(code, reason, url))
+        self.url = url
+        self.code = code
+        self.reason = reason
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+class PooledResponse:
+    """
+    response whose connection goes back to the pool once the body is read
+    """
+
+    def __init__(self, session, key, conn, response):
+        self.session = session
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def read(self, amt=None):
+        data = self.response.read(amt)
+        if amt is None or not data:
+            self.close()
+        return data
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            # body fully consumed, the connection can be reused
+            self.session.release(self.key, self.conn)
+        else:
+            self.response.close()
+            self.conn.close()
+        self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BaseSession:
+    """
+    pool settings and credentials shared by the blocking and the asyncio
+    sessions
+    """
+
+    def __init__(self, poolsize=8, timeout=60):
+        self.poolsize = max(1, poolsize)
+        self.timeout = timeout
+        self.pools = dict()
+        self.authhost = None
+        self.authheader = None
+        # http_proxy, https_proxy and no_proxy, like urlopen
+        self.proxies = urllib.request.getproxies()
+
+    def set_auth(self, baseurl, username, password):
+        """
+        send basic auth credentials with every request to baseurl's host
+        """
+        self.authhost = self.hostkey(urllib.parse.urlsplit(baseurl))
+        token = '{0}:{1}'.format(username, password).encode()
+        self.authheader = 'Basic ' + base64.b64encode(token).decode('ascii')
+
+    @staticmethod
+    def hostkey(parts):
+        port = parts.port
+        if port is None:
+            port = 443 if parts.scheme == 'https' else 80
+        return (parts.scheme, parts.hostname, port)
+
+    def proxy(self, key):
+        """
+        (host, port, headers) of the proxy for key's host, None to connect
+        directly
+        """
+        scheme, host, port = key
+        url = self.proxies.get(scheme)
+        if not url or urllib.request.proxy_bypass_environment(host, self.proxies):
+            return None
+        if '://' not in url:
+            url = 'http://' + url
+        parts = urllib.parse.urlsplit(url)
+        headers = dict()
+        if parts.username:
+            token = '{0}:{1}'.format(urllib.parse.unquote(parts.username),
+                urllib.parse.unquote(parts.password or '')).encode()
+            headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(token).decode('ascii')
+        return parts.hostname, parts.port or 80, headers
+
+    def request_headers(self, key):
+        headers = {'Connection': 'keep-alive'}
+        if self.authheader and key == self.authhost:
+            headers['Authorization'] = self.authheader
+        proxy = self.proxy(key)
+        if proxy and key[0] == 'http':
+            headers.update(proxy[2])
+        return headers
+
+    def request_target(self, key, parts):
+        """
+        the request line target, the whole url when a plain http request
+        goes through a proxy
+        """
+        if key[0] == 'http' and self.proxy(key):
+            return urllib.parse.urlunsplit(parts[:4] + ('',))
+        return self.target(parts)
+
+    @staticmethod
+    def target(parts):
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        return target
+
+
+class HTTPSession(BaseSession):
+    """
+    keep-alive HTTP client with a pool of idle connections per host
+
+    At most poolsize idle connections are kept for each host. Callers
+    never block on the pool: when all pooled connections are busy a new
+    one is opened and closed again after use.
+    """
+
+    def __init__(self, poolsize=8, timeout=60):
+        super(HTTPSession, self).__init__(poolsize, timeout)
+        self.lock = threading.Lock()
+
+    def connect(self, key):
+        scheme, host, port = key
+        proxy = self.proxy(key)
+        if proxy is None:
+            if scheme == 'https':
+                return http.client.HTTPSConnection(host, port, timeout=self.timeout)
+            return http.client.HTTPConnection(host, port, timeout=self.timeout)
+        phost, pport, pheaders = proxy
+        if scheme == 'https':
+            # CONNECT tunnel through the proxy
+            conn = http.client.HTTPSConnection(phost, pport, timeout=self.timeout)
+            conn.set_tunnel(host, port, headers=pheaders)
+            return conn
+        return http.client.HTTPConnection(phost, pport, timeout=self.timeout)
+
+    def acquire(self, key):
+        """
+        return (connection, reused)
+        """
+        with self.lock:
+            idle = self.pools.get(key)
+            if idle:
+                return idle.pop(), True
+        return self.connect(key), False
+
+    def release(self, key, conn):
+        with self.lock:
+            idle = self.pools.setdefault(key, list())
+            if len(idle) < self.poolsize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def send(self, key, target, headers):
+        conn, reused = self.acquire(key)
+        try:
+            conn.request('GET', target, headers=headers)
+            return conn, conn.getresponse()
+        except (http.client.HTTPException, ConnectionError):
+            conn.close()
+            if not reused:
+                raise
+        # the server dropped an idle keep-alive connection, retry once
+        stats.count('http.reconnects')
+        conn = self.connect(key)
+        try:
+            conn.request('GET', target, headers=headers)
+            return conn, conn.getresponse()
+        except Exception:
+            conn.close()
+            raise
+
+    def open(self, url, redirects=5):
+        """
+        GET url and return a PooledResponse, raise HTTPError for errors
+        """
+        for i in range(redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            key = self.hostkey(parts)
+            conn, response = self.send(key, self.request_target(key, parts), self.request_headers(key))
+            result = PooledResponse(self, key, conn, response)
+            if response.status in REDIRECTS and response.getheader('Location'):
+                result.read()
+                url = urllib.parse.urljoin(url, response.getheader('Location'))
+                continue
+            if response.status >= 400:
+                raise HTTPError(url, response.status, response.reason, result.read())
+            return result
+        raise HTTPError(url, response.status, 'too many redirects', b'')
+
+    def close(self):
+        with self.lock:
+            for idle in self.pools.values():
+                for conn in idle:
+                    conn.close()
+            self.pools.clear()
+
+
+class AsyncResponse:
+    """
+    a fully read response of the asyncio session
+    """
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def read(self):
+        return self.body
+
+
+class AsyncHTTPSession(BaseSession):
+    """
+    asyncio HTTP/1.1 client with a pool of idle keep-alive connections
+    per host
+
+    Meant for the small xml api responses: the body is read completely
+    before open() returns. Like HTTPSession it never waits for the pool,
+    a busy pool means a new connection. All calls must come from the
+    same event loop.
+    """
+
+    async def connect(self, key):
+        scheme, host, port = key
+        context = ssl.create_default_context() if scheme == 'https' else None
+        proxy = self.proxy(key)
+        if proxy is None:
+            return await asyncio.wait_for(
+                asyncio.open_connection(host, port, ssl=context), self.timeout)
+        phost, pport, pheaders = proxy
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(phost, pport), self.timeout)
+        if scheme == 'https':
+            try:
+                await asyncio.wait_for(
+                    self.tunnel(reader, writer, host, port, pheaders, context), self.timeout)
+            except BaseException:
+                writer.close()
+                raise
+        return reader, writer
+
+    @staticmethod
+    async def tunnel(reader, writer, host, port, headers, context):
+        """
+        CONNECT to host through the proxy writer is connected to, then
+        switch the connection to TLS
+        """
+        request = ['CONNECT {0}:{1} HTTP/1.1'.format(host, port), 'Host: {0}:{1}'.format(host, port)]
+        request.extend('{0}: {1}'.format(k, v) for k, v in headers.items())
+        writer.write(('\r\n'.join(request) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+        line = await reader.readline()
+        status = (line.decode('latin-1').split(' ', 2) + ['', ''])[1]
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        if status != '200':
+            raise ConnectionError('proxy CONNECT to {0}:{1} failed: {2}'.format(
+                host, port, line.decode('latin-1').strip()))
+        # StreamWriter.start_tls is new in python 3.11
+        await writer.start_tls(context, server_hostname=host)
+
+    async def acquire(self, key):
+        """
+        return (reader, writer, reused)
+        """
+        idle = self.pools.get(key)
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await self.connect(key)
+        return reader, writer, False
+
+    def release(self, key, conn):
+        idle = self.pools.setdefault(key, list())
+        if len(idle) < self.poolsize:
+            idle.append(conn)
+        else:
+            conn[1].close()
+
+    @staticmethod
+    async def read_response(reader):
+        """
+        return (status, reason, headers, body, will_close)
+        """
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError('connection closed by the server')
+        version, status, reason = (line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        lines = list()
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            lines.append(line.decode('latin-1'))
+        headers = email.parser.Parser(_class=http.client.HTTPMessage).parsestr(''.join(lines))
+
+        connection = headers.get('Connection', '').lower()
+        will_close = connection == 'close' or (version == 'HTTP/1.0' and connection != 'keep-alive')
+        if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            chunks = list()
+            while True:
+                size = int((await reader.readline()).split(b';')[0].strip() or b'0', 16)
+                if not size:
+                    # skip the trailer
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b''.join(chunks)
+        elif headers.get('Content-Length') is not None:
+            body = await reader.readexactly(int(headers.get('Content-Length')))
+        else:
+            body = await reader.read()
+            will_close = True
+        return int(status), reason, headers, body, will_close
+
+    async def exchange(self, key, target, headers):
+        reader, writer, reused = await self.acquire(key)
+        host = key[1] if key[2] in (80, 443) else '{0}:{1}'.format(key[1], key[2])
+        request = ['GET {0} HTTP/1.1'.format(target), 'Host: {0}'.format(host)]
+        request.extend('{0}: {1}'.format(k, v) for k, v in headers.items())
+        data = ('\r\n'.join(request) + '\r\n\r\n').encode('latin-1')
+        try:
+            writer.write(data)
+            await writer.drain()
+            status, reason, rheaders, body, will_close = await asyncio.wait_for(
+                self.read_response(reader), self.timeout)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            writer.close()
+            if not reused:
+                raise
+            # the server dropped an idle keep-alive connection, retry once
+            stats.count('http.reconnects')
+            reader, writer = await self.connect(key)
+            try:
+                writer.write(data)
+                await writer.drain()
+                status, reason, rheaders, body, will_close = await asyncio.wait_for(
+                    self.read_response(reader), self.timeout)
+            except BaseException:
+                writer.close()
+                raise
+        except BaseException:
+            writer.close()
+            raise
+        if will_close:
+            writer.close()
+        else:
+            self.release(key, (reader, writer))
+        return AsyncResponse(status, reason, rheaders, body)
+
+    async def open(self, url, redirects=5):
+        """
+        GET url and return an AsyncResponse, raise HTTPError for errors
+        """
+        for i in range(redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            key = self.hostkey(parts)
+            response = await self.exchange(key, self.request_target(key, parts), self.request_headers(key))
+            if response.status in REDIRECTS and response.getheader('Location'):
+                url = urllib.parse.urljoin(url, response.getheader('Location'))
+                continue
+            if response.status >= 400:
+                raise HTTPError(url, response.status, response.reason, response.body)
+            return response
+        raise HTTPError(url, response.status, 'too many redirects', b'')
+
+    async def close(self):
+        for idle in self.pools.values():
+            for reader, writer in idle:
+                writer.close()
+        self.pools.clear()
@@ -0,0 +1,128 @@
+#
+# File: shard.py
+#
+# mt2mw -- package for migrating a Mindtouch wiki to MediaWiki
+# Copyright (C) 2010 Catalyst IT Ltd
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# system library
+import heapq
+
+
+def parse_shard(spec):
+    """
+    "i/N" -> (i, N), shards are numbered from 1
+    """
+    try:
+        index, count = (int(part) for part in spec.split('/'))
+    except ValueError:
+        raise ValueError('shard must look like i/N: {0}'.format(spec))
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError('shard {0} is not between 1/{1} and {1}/{1}'.format(spec, count))
+    return index, count
+
+
+class ShardPlan:
+    """
+    splits a page tree into count shards of about the same weight
+
+    A page weighs 1 plus file_weight for each of its attachments (when
+    they were listed before the plan is made). Subtrees no heavier than
+    half an even share stay whole, heavier ones are split into their
+    root and the subtrees below it. The pieces then go, heaviest first,
+    to the lightest shard, which keeps every shard within half a share
+    of the even split. The plan only depends on the tree, so every node
+    computes the same one from the same sitemap.
+    """
+
+    def __init__(self, root, count, file_weight=1.0):
+        self.count = max(1, count)
+        self.file_weight = file_weight
+        # page id -> shard, numbered from 1
+        self.assignment = dict()
+        self.weights = [0.0] * self.count
+        self.pages = [0] * self.count
+
+        weights = self.subtree_weights(root)
+        limit = weights[id(root)] / self.count / 2
+        units = list()
+        stack = [root]
+        while stack:
+            page = stack.pop()
+            if weights[id(page)] <= limit or not page.subpages:
+                units.append((weights[id(page)], len(units), page, True))
+            else:
+                # too heavy: the page alone, then its subtrees
+                units.append((self.weight(page), len(units), page, False))
+                stack.extend(reversed(page.subpages))
+
+        loads = [(0.0, shard) for shard in range(1, self.count + 1)]
+        for weight, order, page, whole in sorted(units, key=lambda u: (-u[0], u[1])):
+            load, shard = heapq.heappop(loads)
+            heapq.heappush(loads, (load + weight, shard))
+            self.weights[shard - 1] += weight
+            if not whole:
+                self.assign(page, shard)
+                continue
+            todo = [page]
+            while todo:
+                p = todo.pop()
+                self.assign(p, shard)
+                todo.extend(p.subpages)
+
+    def assign(self, page, shard):
+        self.assignment[page.id] = shard
+        self.pages[shard - 1] += 1
+
+    def weight(self, page):
+        files = page.files if page.files_loaded() else ()
+        return 1 + self.file_weight * len(files)
+
+    def subtree_weights(self, root):
+        """
+        id(page) -> weight of the page and everything below it
+        """
+        weights = dict()
+        order = list()
+        stack = [root]
+        while stack:
+            page = stack.pop()
+            order.append(page)
+            stack.extend(page.subpages)
+        for page in reversed(order):
+            weights[id(page)] = self.weight(page) + sum(
+                weights[id(s)] for s in page.subpages)
+        return weights
+
+    def shard_of(self, page):
+        return self.assignment.get(page.id)
+
+    def walk(self, root, shard):
+        """
+        the pages of one shard, parents before their subpages
+        """
+        stack = [root]
+        while stack:
+            page = stack.pop()
+            # taken first, the page may be released once it is written
+            stack.extend(reversed(page.subpages))
+            if self.assignment.get(page.id) == shard:
+                yield page
+
+    def summary(self):
+        return ', '.join('{0}/{1}: {2} pages, weight {3:g}'.format(
+            shard, self.count, self.pages[shard - 1], self.weights[shard - 1])
+            for shard in range(1, self.count + 1))
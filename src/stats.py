@@ -0,0 +1,195 @@
+#
+# File: stats.py
+#
+# mt2mw -- package for migrating a Mindtouch wiki to MediaWiki
+# Copyright (C) 2010 Catalyst IT Ltd
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# system library
+import csv
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# our library
+from log import get_logger
+
+log = get_logger('progress')
+
+# histogram bucket upper bounds in seconds: 1ms, 2ms, 4ms ... ~65s, inf
+BUCKETS = [0.001 * 2 ** i for i in range(17)] + [float('inf')]
+
+
+class Timer:
+    """
+    latency histogram of one operation
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+    def percentile(self, p):
+        """
+        upper bound of the bucket holding the p-th percentile
+        """
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total': round(self.total, 6),
+            'mean': round(self.total / self.count, 6) if self.count else 0.0,
+            'min': round(self.min or 0.0, 6),
+            'max': round(self.max, 6),
+            'p50': round(self.percentile(50), 6),
+            'p95': round(self.percentile(95), 6),
+            'p99': round(self.percentile(99), 6),
+            'buckets': dict(
+                ('le_%g' % bound, n) for bound, n in zip(BUCKETS, self.buckets) if n
+            ),
+        }
+
+
+class Stats:
+    """
+    timers and counters for the hot paths of a migration run
+
+    Timers are named after what they measure (mindtouch.request,
+    convert, mediawiki.edit, download, postgres.insert ...), counters
+    hold totals such as bytes transferred and retries.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.timers = dict()
+        self.counters = dict()
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = Timer()
+            timer.add(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        with self.lock:
+            elapsed = time.time() - self.started
+            return {
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'elapsed': round(elapsed, 3),
+                'timers': dict((name, t.summary()) for name, t in sorted(self.timers.items())),
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def write_report(self, path):
+        """
+        write the report as csv if path ends in .csv, else as json
+        """
+        report = self.report()
+        with open(path, 'w', newline='') as f:
+            if not path.endswith('.csv'):
+                json.dump(report, f, indent=2)
+                f.write('\n')
+                return
+            out = csv.writer(f)
+            out.writerow(['name', 'count', 'total', 'mean', 'min', 'max', 'p50', 'p95', 'p99'])
+            for name, t in report['timers'].items():
+                out.writerow([name] + [t[k] for k in
+                    ('count', 'total', 'mean', 'min', 'max', 'p50', 'p95', 'p99')])
+            for name, value in report['counters'].items():
+                out.writerow([name, value])
+            out.writerow(['elapsed', 1, report['elapsed']])
+
+
+class Progress:
+    """
+    logs pages/sec and, when the total is known, an ETA, at most once
+    every interval seconds
+    """
+
+    def __init__(self, total=None, interval=10):
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.started = time.time()
+        self.shown = self.started
+        self.lock = threading.Lock()
+
+    def skip(self, n=1):
+        """
+        n pages need no work (done by an earlier run), they leave the
+        total instead of counting as done, so the rate and ETA only
+        reflect the pages really written
+        """
+        with self.lock:
+            if self.total:
+                self.total = max(self.total - n, 0)
+
+    def tick(self, n=1):
+        with self.lock:
+            self.done += n
+            now = time.time()
+            if not self.interval or now - self.shown < self.interval:
+                return
+            self.shown = now
+            rate = self.done / max(now - self.started, 1e-6)
+            msg = "Progress: {0} pages, {1:.1f} pages/sec".format(self.done, rate)
+            if self.total:
+                left = max(self.total - self.done, 0)
+                eta = time.strftime('%H:%M:%S', time.gmtime(left / rate)) if rate else '?'
+                msg = "Progress: {0}/{1} pages, {2:.1f} pages/sec, ETA {3}".format(
+                    self.done, self.total, rate, eta)
+        log.info(msg)
+
+
+# the registry used by every module
+stats = Stats()
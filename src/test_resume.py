@@ -0,0 +1,108 @@
+#
+# File: test_resume.py
+#
+# mt2mw -- package for migrating a Mindtouch wiki to MediaWiki
+# Copyright (C) 2010 Catalyst IT Ltd
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+--resume against the fake wikis of benchmark.py
+
+    python -m unittest test_resume
+"""
+
+# system library
+import os
+import shutil
+import tempfile
+import unittest
+import configparser as cp
+import multiprocessing as mp
+
+# our library
+from benchmark import serve, server_stats
+from journal import Journal
+
+TREE = dict(depth=1, fanout=2, page_size=512, attachments=1, attachment_size=1024)
+
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='mt2mw-test-')
+        self.journalfile = os.path.join(self.workdir, 'journal.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def migrate(self, args, fail_files=()):
+        """
+        run mt2mw against fresh fake wikis, return the mindtouch counters
+        """
+        # imported here so the server process does not load the converter
+        from mt2mw import mt2mwapp
+
+        ctx = mp.get_context('spawn')
+        conn, child = ctx.Pipe()
+        proc = ctx.Process(target=serve, args=(TREE, child, fail_files), daemon=True)
+        proc.start()
+        try:
+            mturl, mwurl = conn.recv()
+            cfg = cp.ConfigParser(interpolation=None)
+            cfg['config'] = {
+                'mindtouch_url': mturl,
+                'mindtouch_user': '',
+                'mindtouch_password': '',
+                'mediawiki_url': mwurl,
+                'mediawiki_user': 'test',
+                'mediawiki_password': 'test',
+                'direct_db': '',
+                'dataroot': os.path.join(self.workdir, 'images'),
+                'staging_dir': os.path.join(self.workdir, 'staging'),
+                'journal_file': self.journalfile,
+                'converter_engine': 'native',
+                'progress_interval': '0',
+                'log_level': 'error',
+            }
+            configfile = os.path.join(self.workdir, 'config.ini')
+            with open(configfile, 'w') as f:
+                cfg.write(f)
+            app = mt2mwapp()
+            app.configfile = configfile
+            app.main_cli(['mt2mw'] + args)
+            return server_stats(mturl)
+        finally:
+            conn.close()
+            proc.join(10)
+
+    def test_failed_file_is_retried_on_resume(self):
+        # page 2 has attachment 2000, File-2-0.bin
+        self.migrate([], fail_files=[2000])
+        journal = Journal(self.journalfile)
+        self.assertFalse(journal.file_done('File-2-0.bin'))
+        self.assertFalse(journal.page_done('2'))
+        self.assertTrue(journal.page_done('3'))
+        journal.close()
+
+        stats = self.migrate(['--resume'])
+        self.assertEqual(stats['downloads'], 1)
+        journal = Journal(self.journalfile)
+        self.assertTrue(journal.file_done('File-2-0.bin'))
+        self.assertTrue(journal.page_done('2'))
+        journal.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+#
+# File: titles.py
+#
+# mt2mw -- package for migrating a Mindtouch wiki to MediaWiki
+# Copyright (C) 2010 Catalyst IT Ltd
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# system library
+import re
+import threading
+
+# our library
+from log import get_logger
+
+log = get_logger('titles')
+
+# characters MediaWiki does not allow in page titles
+INVALID_CHARS = re.compile(r'[#<>[\]|{}\n\r]')
+# runs of spaces and underscores, MediaWiki treats them as one space
+SPACES = re.compile(r'[ _]+')
+
+
+def sanitize_title(title):
+    """
+    replace the characters MediaWiki does not allow in titles with "_"
+    """
+    return INVALID_CHARS.sub('_', title)
+
+
+def title_key(title):
+    """
+    the form MediaWiki stores a title under: one space for any run of
+    spaces and underscores, trimmed, first letter upper case
+    """
+    title = SPACES.sub(' ', title).strip()
+    return title[:1].upper() + title[1:]
+
+
+class TitleIndex:
+    """
+    page id -> MediaWiki title, built once over the whole page tree
+
+    Titles come from the page path (or only the page title when the
+    hierarchy is flattened) with the invalid characters replaced. When
+    several pages end up with the same title the page with the lowest id
+    keeps it and the others get their id appended, "Title (1234)", so
+    the result does not depend on the order the pages are seen in.
+    Pages that were not in the tree given to build (the streamed
+    sitemap) are added on first lookup, there the first page seen keeps
+    the title.
+    """
+
+    def __init__(self, hierarchy=True):
+        self.hierarchy = hierarchy
+        self.lock = threading.Lock()
+        self.titles = dict()
+        # title_key -> page id holding that title
+        self.taken = dict()
+        # (page id, wanted title, given title) for every renamed page
+        self.collisions = list()
+
+    def source(self, page):
+        if self.hierarchy:
+            return page.path or page.title
+        return page.title
+
+    def candidate(self, page):
+        return sanitize_title(self.source(page))
+
+    @staticmethod
+    def sort_key(page):
+        id = str(page.id)
+        return (0, int(id), '') if id.isdigit() else (1, 0, id)
+
+    def build(self, root):
+        """
+        index root and every page below it
+        """
+        groups = dict()
+        stack = [root]
+        while stack:
+            page = stack.pop()
+            stack.extend(page.subpages)
+            wanted = self.candidate(page)
+            groups.setdefault(title_key(wanted), list()).append((page, wanted))
+        with self.lock:
+            for key, pages in groups.items():
+                pages.sort(key=lambda item: self.sort_key(item[0]))
+                for page, wanted in pages:
+                    self.assign(page, wanted)
+        if self.collisions:
+            log.warning("%d pages renamed to avoid title collisions", len(self.collisions))
+
+    def assign(self, page, wanted):
+        if page.id in self.titles:
+            return self.titles[page.id]
+        title = wanted
+        if title != self.source(page):
+            log.debug("SANITIZED TITLE: %s", title)
+        n = 1
+        while title_key(title) in self.taken:
+            suffix = page.id if n == 1 else '{0}-{1}'.format(page.id, n)
+            title = '{0} ({1})'.format(wanted, suffix)
+            n += 1
+        if title != wanted:
+            self.collisions.append((page.id, wanted, title))
+            log.warning("Title '%s' of page %s is taken, using '%s'", wanted, page.id, title)
+        self.taken[title_key(title)] = page.id
+        self.titles[page.id] = title
+        return title
+
+    def title(self, page):
+        title = self.titles.get(page.id)
+        if title is None:
+            with self.lock:
+                title = self.assign(page, self.candidate(page))
+        return title
+
+    def __contains__(self, page):
+        return page.id in self.titles
+
+    def __len__(self):
+        return len(self.titles)
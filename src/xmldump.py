@@ -0,0 +1,153 @@
+#
+# File: xmldump.py
+#
+# mt2mw -- package for migrating a Mindtouch wiki to MediaWiki
+# Copyright (C) 2010 Catalyst IT Ltd
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# system library
+import os
+import shlex
+import subprocess as sp
+import threading
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape
+
+# our library
+import wikitools3 as wt
+from log import get_logger
+
+log = get_logger('xmldump')
+
+HEADER = ('<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" '
+          'version="0.10" xml:lang="en">\n')
+FOOTER = '</mediawiki>\n'
+
+PAGE = '''  <page>
+    <title>{title}</title>
+    <revision>
+      <timestamp>{timestamp}</timestamp>
+      <contributor>
+        <username>{user}</username>
+      </contributor>
+      <comment>{comment}</comment>
+      <model>wikitext</model>
+      <format>text/x-wiki</format>
+      <text xml:space="preserve">{text}</text>
+    </revision>
+  </page>
+'''
+
+
+class XMLDumpWriter:
+    """
+    writes pages to MediaWiki export XML as they come in
+
+    Nothing but the current page is held in memory. With pages_per_file
+    the dump is split into numbered parts (dump.0001.xml, ...) small
+    enough to send to the api import module one at a time.
+    """
+
+    def __init__(self, path, user, pages_per_file=0, comment='Imported from MindTouch'):
+        self.path = path
+        self.user = user
+        self.comment = comment
+        self.pages_per_file = pages_per_file
+        self.lock = threading.Lock()
+        self.files = list()
+        self.out = None
+        self.count = 0
+        self.pagecount = 0
+
+    def part_path(self):
+        if not self.pages_per_file:
+            return self.path
+        base, ext = os.path.splitext(self.path)
+        return '{0}.{1:04d}{2}'.format(base, len(self.files) + 1, ext or '.xml')
+
+    def open_part(self):
+        path = self.part_path()
+        self.out = open(path, 'w', encoding='utf-8')
+        self.out.write(HEADER)
+        self.files.append(path)
+        self.count = 0
+
+    def close_part(self):
+        if self.out:
+            self.out.write(FOOTER)
+            self.out.close()
+            self.out = None
+
+    def add_page(self, title, text):
+        timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        with self.lock:
+            if self.out is None:
+                self.open_part()
+            self.out.write(PAGE.format(
+                title=escape(title),
+                timestamp=timestamp,
+                user=escape(self.user),
+                comment=escape(self.comment),
+                text=escape(text),
+            ))
+            self.count += 1
+            self.pagecount += 1
+            if self.pages_per_file and self.count >= self.pages_per_file:
+                self.close_part()
+
+    def close(self):
+        with self.lock:
+            self.close_part()
+        return self.files
+
+
+def import_local(files, command):
+    """
+    load the dump with a local importer, command is a shell style line
+    with {file} where the dump goes, for example
+    php /var/www/mediawiki/maintenance/importDump.php {file}
+    """
+    for path in files:
+        log.info("Importing %s", path)
+        sp.run([arg.format(file=path) for arg in shlex.split(command)], check=True)
+
+
+def import_api(site, files, interwikiprefix='mindtouch', call=None):
+    """
+    send the dump parts to the api import module one at a time, call
+    wraps each request (MWWiki.api) when given
+    """
+    if call is None:
+        call = lambda func, *args, **kwargs: func(*args, **kwargs)
+    tokens = call(wt.api.APIRequest(site, {
+        'action': 'query',
+        'meta': 'tokens',
+    }).query, querycontinue=False)
+    token = tokens['query']['tokens']['csrftoken']
+    for path in files:
+        log.info("Importing %s", path)
+        with open(path, 'rb') as xml:
+            def send():
+                xml.seek(0)
+                return wt.api.APIRequest(site, {
+                    'action': 'import',
+                    'interwikiprefix': interwikiprefix,
+                    'xml': xml,
+                    'token': token,
+                }, write=True, multipart=True).query(querycontinue=False)
+            result = call(send)
+        if 'error' in result:
+            raise Exception('import of {0} failed: {1}'.format(path, result['error']))